@@ -0,0 +1,104 @@
+#!/usr/bin/python
+import getopt
+import hashlib
+import sys
+import time
+
+from block import Block
+from transaction import Transaction
+
+
+def naive_proof_of_work(block, difficulty, start_nonce, end_nonce):
+    """
+    The nonce search as it was before the midstate reuse: the whole header is
+    encoded and hashed again for every nonce.
+    """
+    zeros = [0 for _ in range(difficulty)]
+    transactions_digest = block.transactions_digest()
+    for nonce in xrange(start_nonce, end_nonce + 1):
+        digest = hashlib.sha256(block.author() + block.previous() +
+                                transactions_digest + str(nonce)).digest()
+        if digest[:difficulty] == bytearray(zeros):
+            return nonce, digest
+
+    return None
+
+
+def fast_proof_of_work(block, difficulty, start_nonce, end_nonce):
+    """
+    The nonce search used by Block.proof_of_work.
+    """
+    return Block.search_nonce(block.header_prefix(), difficulty,
+                              start_nonce, end_nonce)
+
+
+def measure(search, block, difficulty, nonces):
+    """
+    Runs a nonce search and measures its hash rate.
+
+    :returns the hashes per second.
+    """
+    start = time.time()
+    search(block, difficulty, 0, nonces - 1)
+    return nonces / (time.time() - start)
+
+
+def sample_block(transactions):
+    """
+    Builds a block with unsigned transactions to be mined.
+    """
+    return Block('QC' + '0' * 40,
+                 [Transaction('QC{:040d}'.format(i),
+                              [(None, 0.1), ('QC' + 'f' * 40, 1.0)],
+                              'signature', 'public_key')
+                  for i in range(transactions)],
+                 hashlib.sha256('genesis_block').digest())
+
+
+def print_help():
+    """
+    Shows the help to the benchmark options.
+    """
+    print("\tBenchmarks the proof of work nonce search.")
+    print("\tOptions:")
+    print("\t\t-h(--help)\t\t\tShows this help message")
+    print("\t\t-n(--nonces) <value>\t\tNumber of nonces hashed by each run")
+    print("\t\t-t(--transactions) <value>\tNumber of transactions in the "
+          "block")
+
+
+if __name__ == "__main__":
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "hn:t:",
+                                ["help", "nonces:", "transactions:"])
+    except getopt.GetoptError:
+        print_help()
+        exit()
+
+    nonces = 200000
+    transactions = 100
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            exit()
+        elif opt in ('-n', '--nonces'):
+            nonces = int(arg)
+        elif opt in ('-t', '--transactions'):
+            transactions = int(arg)
+
+    block = sample_block(transactions)
+
+    # Both searches must find the same nonce and the digest checked by valid
+    expected = naive_proof_of_work(block, 1, 0, nonces)
+    found = fast_proof_of_work(block, 1, 0, nonces)
+    assert expected == found
+    if found is not None:
+        block.proof_of_work(1, found[0], found[0])
+        assert block.valid(1)
+
+    # A difficulty no nonce satisfies, so every nonce is hashed
+    before = measure(naive_proof_of_work, block, 32, nonces)
+    after = measure(fast_proof_of_work, block, 32, nonces)
+    print("Nonces: {}; Transactions: {}".format(nonces, transactions))
+    print("Before: {:.0f} hashes/s".format(before))
+    print("After: {:.0f} hashes/s ({:.2f}x)".format(after, after / before))
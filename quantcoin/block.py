@@ -20,6 +20,9 @@ class Block:
     is limited by the block validation as well.
     """
 
+    # The previous block referenced by the first block of the chain
+    GENESIS = 'genesis_block'
+
     def __init__(self, author, transactions, previous_block, nonce=None,
                  digest=None):
         """
@@ -35,6 +38,9 @@ class Block:
         :param nonce: the nonce value used to achieve the requested zeroes to
                 include this block in the chain
         :param digest: the digest value of this block
+
+        Blocks are immutable once they have a nonce. Everything derived from
+        the transactions and the header is computed once and kept.
         """
         if author is None:
             raise Exception("A block must have an author.")
@@ -45,11 +51,19 @@ class Block:
                             "previous one.")
 
         self._author = author
-        self._transactions = transactions
+        self._transactions = tuple(transactions)
         self._previous_block = previous_block
         self._nonce = nonce
         self._digest = digest
 
+        self._sorted_transactions = None
+        self._commission = None
+        self._merkle_levels = None
+        self._transaction_index = None
+        self._encoded_author = None
+        self._encoded_previous = None
+        self._encoded_digest = None
+
     @staticmethod
     def from_json(data):
         """
@@ -60,11 +74,7 @@ class Block:
         transactions = []
         if 'transactions' in data.keys():
             for transaction in data['transactions']:
-                transaction_object = Transaction(transaction['body']['from_wallet'],
-                                                 transaction['body']['to_wallets'],
-                                                 transaction['signature'],
-                                                 transaction['public_key'])
-                transactions.append(transaction_object)
+                transactions.append(Transaction.from_json(transaction))
 
         block = Block(data['author'], transactions,
                       binascii.a2b_base64(data['previous']),
@@ -89,51 +99,145 @@ class Block:
 
             return dictionary
 
+    def compact_json(self, prefilled):
+        """
+        Encode this block in JSON without the transactions peers are expected
+        to have, only their txids are kept.
+
+        :param prefilled: a function telling if a transaction must be sent
+                along, the coin creation transaction is always sent.
+        """
+        if self.nonce() is not None:
+            return {
+                'author': self.author(),
+                'nonce': self.nonce(),
+                'digest': self.digest(),
+                'previous': self.previous(),
+                'txids': [t.txid() for t in self.transactions()],
+                'transactions': [t.json() for t in self.transactions()
+                                 if t.from_wallet() is None or prefilled(t)]
+            }
+
     def transactions(self):
         """
-        :returns the set of transactions included in this block sorted.
+        :returns the set of transactions included in this block sorted by
+                 sender and txid. Coin creation transactions come first.
         """
-        return sorted(self._transactions,
-                      lambda transaction1, transaction2:
-                      transaction1.from_wallet() < transaction2.from_wallet())
+        if self._sorted_transactions is None:
+            self._sorted_transactions = tuple(sorted(
+                self._transactions,
+                key=lambda transaction: (transaction.from_wallet() or '',
+                                         transaction.txid())))
+        return self._sorted_transactions
 
     def previous(self):
         """
         :returns the reference to the previous block.
         """
-        return binascii.b2a_base64(self._previous_block)
+        if self._encoded_previous is None:
+            self._encoded_previous = binascii.b2a_base64(self._previous_block)
+        return self._encoded_previous
 
     def commission(self):
         """
         :return: The sum of all commissions earned in this block
         """
-        commission = 0.0
-        for transaction in self.transactions():
-            commission += transaction.commission()
+        if self._commission is None:
+            commission = 0.0
+            for transaction in self.transactions():
+                commission += transaction.commission()
+            self._commission = commission
 
-        return commission
+        return self._commission
 
     def transactions_digest(self):
         """
         Obtains the digest value of the tree root of the transactions digests
         """
-        ordered_transactions = self.transactions()
-        if len(ordered_transactions) == 0:
-            return hashlib.sha256("").digest()
+        return self._merkle_tree()[-1][0]
+
+    def merkle_proof(self, transaction):
+        """
+        Obtains the proof that a transaction is included in this block. The
+        proof holds the sibling of every node in the path from the leaf of the
+        transaction to the tree root.
+
+        :param transaction: the transaction included in this block.
+
+        :returns a list of (sibling digest, True if the sibling is on the left)
+                 tuples from the leaf level up, None if the transaction is not
+                 in this block.
+        """
+        if self._transaction_index is None:
+            self._transaction_index = dict(
+                (included.txid(), index)
+                for index, included in enumerate(self.transactions()))
+
+        index = self._transaction_index.get(transaction.txid())
+        if index is None:
+            return None
+
+        proof = []
+        for level in self._merkle_tree()[:-1]:
+            if index % 2 == 1:
+                proof.append((level[index - 1], True))
+            else:
+                sibling = level[index + 1] if index + 1 < len(level) else ""
+                proof.append((sibling, False))
+            index //= 2
+
+        return proof
+
+    @staticmethod
+    def verify_merkle_proof(transaction, proof, root):
+        """
+        Checks a Merkle inclusion proof without the other transactions of the
+        block. The root, hashed with the author, previous digest and nonce of
+        the block, must give the block digest.
 
-        queue = []
-        for transaction in ordered_transactions:
-            queue.append(hashlib.sha256(transaction.json()).digest())
+        :param transaction: the transaction supposedly included.
+        :param proof: the proof obtained from merkle_proof.
+        :param root: the tree root of the transactions digests of the block.
 
-        if len(queue) % 2 == 1:  # we have and odd number of transactions
-            queue.append("")  # append and empty string
+        :returns True if the proof leads from the transaction to the root.
+        """
+        digest = hashlib.sha256(transaction.serialize()).digest()
+        for sibling, on_left in proof:
+            if on_left:
+                digest = hashlib.sha256(sibling + digest).digest()
+            else:
+                digest = hashlib.sha256(digest + sibling).digest()
+
+        return digest == root
+
+    def _merkle_tree(self):
+        """
+        Builds the tree of the transactions digests level by level, from the
+        leaves to the root, in linear time. A level with an odd number of
+        nodes pairs its last node with an empty string. The leaves are always
+        hashed at least once, even when there is a single one.
+
+        :returns the levels of the tree, the last one holding only the root.
+        """
+        if self._merkle_levels is None:
+            ordered_transactions = self.transactions()
+            if len(ordered_transactions) == 0:
+                self._merkle_levels = [[hashlib.sha256("").digest()]]
+                return self._merkle_levels
 
-        while len(queue) > 1:
-            pair, queue = queue[:2], queue[2:]
-            pair_hash = hashlib.sha256(pair[0] + pair[1]).digest()
-            queue.append(pair_hash)
+            level = [hashlib.sha256(transaction.serialize()).digest()
+                     for transaction in ordered_transactions]
+            levels = [level]
+            while len(level) > 1 or len(levels) == 1:
+                level = [hashlib.sha256(level[i] +
+                                        (level[i + 1] if i + 1 < len(level)
+                                         else "")).digest()
+                         for i in xrange(0, len(level), 2)]
+                levels.append(level)
 
-        return queue[0]
+            self._merkle_levels = levels
+
+        return self._merkle_levels
 
     def proof_of_work(self, difficulty, start_nonce, end_nonce):
         """
@@ -145,38 +249,59 @@ class Block:
         :param end_nonce: the nonce to end the search
         """
         if self._nonce is None:
-            zeros = [0 for _ in range(difficulty)]
-            transactions_digest = self.transactions_digest()
-            nonce = start_nonce
-            digest = hashlib.sha256(self.author() + self.previous() +
-                                    transactions_digest + str(nonce)).digest()
-            while digest[:difficulty] != bytearray(zeros):
-                nonce = nonce + 1
-                if nonce > end_nonce:
-                    return False
-
-                digest = hashlib.sha256(self.author() + self.previous() +
-                                        transactions_digest + str(nonce)).digest()
-
-            self._nonce = nonce
-            self._digest = digest
+            found = Block.search_nonce(self.header_prefix(), difficulty,
+                                       start_nonce, end_nonce)
+            if found is None:
+                return False
+
+            self._nonce, self._digest = found
             return True
         else:
             return True
 
+    def header_prefix(self):
+        """
+        The part of the data hashed for the digest of this block that does
+        not depend on the nonce.
+        """
+        return self.author() + self.previous() + self.transactions_digest()
+
+    @staticmethod
+    def search_nonce(prefix, difficulty, start_nonce, end_nonce):
+        """
+        Searches a range of nonces for a digest satisfying the difficulty.
+        The prefix is hashed once and its SHA256 state is copied for every
+        nonce, so only the nonce itself is hashed in the loop. The digests
+        are the same computed by valid.
+
+        :param prefix: the header prefix of the block
+        :param difficulty: the difficulty required by the blockchain
+        :param start_nonce: the nonce to begin the search
+        :param end_nonce: the last nonce searched
+
+        :returns a (nonce, digest) tuple, None if no nonce in the range
+                 satisfies the difficulty.
+        """
+        zeros = '\x00' * difficulty
+        copy = hashlib.sha256(prefix).copy
+        for nonce in xrange(start_nonce, end_nonce + 1):
+            sha = copy()
+            sha.update(str(nonce))
+            digest = sha.digest()
+            if digest[:difficulty] == zeros:
+                return nonce, digest
+
+        return None
+
     def valid(self, difficulty):
         """
         Checks if the block is valid.
         """
         if self._nonce is not None:
-            zeros = [0 for _ in range(difficulty)]
-            transactions_digest = self.transactions_digest()
-            calculated_digest = hashlib.sha256(self.author() +
-                                               self.previous() +
-                                               transactions_digest +
+            calculated_digest = hashlib.sha256(self.header_prefix() +
                                                str(self._nonce)).digest()
             return calculated_digest == self._digest and \
-                calculated_digest[:difficulty] == bytearray(zeros)
+                calculated_digest[:difficulty] == '\x00' * difficulty
         else:
             return False
 
@@ -190,16 +315,26 @@ class Block:
         """
         The digest value of this block
         """
-        return binascii.b2a_base64(self._digest)
+        if self._encoded_digest is None and self._digest is not None:
+            self._encoded_digest = binascii.b2a_base64(self._digest)
+        return self._encoded_digest
+
+    def raw_digest(self):
+        """
+        The digest value of this block, not encoded.
+        """
+        return self._digest
 
     def author(self):
         """
         Returns the address of the author of this block.
         """
-        return self._author.encode('utf-8')
+        if self._encoded_author is None:
+            self._encoded_author = self._author.encode('utf-8')
+        return self._encoded_author
 
     def __eq__(self, other):
         if not isinstance(other, Block):
             return False
 
-        return self.digest() == other.digest()
+        return self._digest == other._digest
@@ -0,0 +1,365 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from block import Block
+
+
+class BlockStore(object):
+    """
+    A BlockStore keeps the blockchain on disk as an append-only log. Every
+    accepted block is written exactly once as a length-prefixed record, so the
+    cost of storing a block does not depend on the height of the chain.
+
+    The log is split in segments. Each segment file is named after the height
+    of its first block. A record is a header with the payload length and its
+    CRC32, followed by the JSON of the block. Records torn by a crash are
+    detected through the CRC32 and truncated when the store is opened.
+
+    An index file maps every height to the segment, offset and length of its
+    record and to the block digest. The segments and the index are memory
+    mapped, so a range of blocks can be handed to a peer straight from the
+    mapped region without building any block.
+    """
+
+    RECORD_HEADER = struct.Struct("!II")
+    INDEX_ENTRY = struct.Struct("!IQI32s")
+    INDEX_NAME = "index.dat"
+    SEGMENT_PREFIX = "blocks-"
+    SEGMENT_SUFFIX = ".dat"
+    DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+    DEFAULT_FSYNC_INTERVAL = 10
+
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE,
+                 fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        """
+        Instantiates a block store.
+
+        :param path: the directory where the segments are kept.
+        :param segment_size: the size in bytes after which a new segment is
+                started.
+        :param fsync_interval: the number of blocks appended between two
+                fsync calls. 1 syncs every block to the disk.
+        """
+        if fsync_interval < 1:
+            raise Exception("The fsync interval must be at least one block.")
+
+        self._path = path
+        self._segment_size = segment_size
+        self._fsync_interval = fsync_interval
+        self._segments = []
+        self._height = 0
+        self._tip = None
+        self._writer = None
+        self._index = None
+        self._maps = {}
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def open(self):
+        """
+        Opens the store, creating its directory if needed. Only the tail of
+        the index and of the last segment is read, to drop entries and records
+        left incomplete by a crash and to index records written after the
+        last index entry.
+        """
+        logging.debug("Opening block store(path={})".format(self._path))
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+        self._segments = sorted(self._segment_start(name)
+                                for name in os.listdir(self._path)
+                                if self._is_segment(name))
+        if len(self._segments) == 0:
+            self._segments.append(0)
+
+        index_path = os.path.join(self._path, self.INDEX_NAME)
+        self._index = open(index_path, 'a+b')
+        entry_size = self.INDEX_ENTRY.size
+        index_size = os.path.getsize(index_path)
+        self._height = index_size // entry_size
+
+        # Drops the index entries pointing to records that did not survive
+        while self._height > 0 and not self._entry_valid(self._height - 1):
+            self._height -= 1
+        if self._height * entry_size != index_size:
+            self._unmap(None)
+            self._index.truncate(self._height * entry_size)
+
+        # Indexes the records appended after the last index entry
+        if self._height > 0:
+            segment, offset, length, _ = self._entry(self._height - 1)
+            offset += self.RECORD_HEADER.size + length
+        else:
+            segment, offset = self._segments[0], 0
+
+        for segment_start in self._segments:
+            if segment_start < segment:
+                continue
+            segment_path = self._segment_path(segment_start)
+            if not os.path.exists(segment_path):
+                continue
+            with open(segment_path, 'rb') as fp:
+                fp.seek(offset if segment_start == segment else 0)
+                for record_offset, payload in self._records(fp):
+                    block = Block.from_json(json.loads(payload))
+                    self._index.write(self.INDEX_ENTRY.pack(
+                        segment_start, record_offset, len(payload),
+                        block.raw_digest()))
+                    self._height += 1
+                valid_size = fp.tell()
+
+            if segment_start == self._segments[-1] and \
+                    valid_size != os.path.getsize(segment_path):
+                logging.warn("Truncating incomplete block record(segment={})".
+                             format(segment_path))
+                with open(segment_path, 'r+b') as fp:
+                    fp.truncate(valid_size)
+
+        self._index.flush()
+        if self._height > 0:
+            self._tip = self.block(self._height - 1)
+
+        self._writer = open(self._segment_path(self._segments[-1]), 'ab')
+
+    def close(self):
+        """
+        Syncs and closes the store.
+        """
+        with self._lock:
+            if self._writer is not None:
+                self._sync()
+                self._writer.close()
+                self._index.close()
+                self._writer = None
+                self._index = None
+            for segment_map in self._maps.values():
+                segment_map.close()
+            self._maps = {}
+
+    def sync(self):
+        """
+        Forces every appended block to the disk.
+        """
+        with self._lock:
+            if self._writer is not None:
+                self._sync()
+
+    def append(self, block):
+        """
+        Appends a block to the end of the log and indexes it.
+
+        :param block: the block to be stored.
+
+        :returns the height of the stored block.
+        """
+        payload = json.dumps(block.json())
+        with self._lock:
+            if self._writer.tell() >= self._segment_size:
+                self._rotate()
+
+            offset = self._writer.tell()
+            header = self.RECORD_HEADER.pack(len(payload),
+                                             zlib.crc32(payload) & 0xffffffff)
+            self._writer.write(header + payload)
+            self._index.write(self.INDEX_ENTRY.pack(
+                self._segments[-1], offset, len(payload), block.raw_digest()))
+            height = self._height
+            self._height += 1
+            self._tip = block
+
+            self._unsynced += 1
+            if self._unsynced >= self._fsync_interval:
+                self._sync()
+            else:
+                self._writer.flush()
+                self._index.flush()
+
+            return height
+
+    def block(self, height):
+        """
+        Reads a single block through the index.
+
+        :param height: the height of the block.
+        """
+        return Block.from_json(json.loads(self.raw(height)[:]))
+
+    def raw(self, height):
+        """
+        Obtains the JSON record of a block as a read only buffer over the
+        mapped segment. No copy of the record is made.
+
+        :param height: the height of the block.
+        """
+        segment, offset, length, _ = self._entry(height)
+        offset += self.RECORD_HEADER.size
+        return buffer(self._map(segment, offset + length), offset, length)
+
+    def raw_range(self, start, end):
+        """
+        Obtains the JSON records of a range of blocks as buffers over the
+        mapped segments.
+
+        :param start: the height of the first block.
+        :param end: the height after the last block.
+        """
+        return [self.raw(height) for height in xrange(start, end)]
+
+    def digest(self, height):
+        """
+        Obtains the raw digest of the block at a height from the index.
+        """
+        return self._entry(height)[3]
+
+    def blocks(self, start=0):
+        """
+        Reads the stored blocks in order.
+
+        :param start: the height of the first block to be read.
+
+        :returns a generator of blocks.
+        """
+        if start >= self._height:
+            return
+        first_segment, offset, _, _ = self._entry(start)
+        for segment_start in self._segments:
+            if segment_start < first_segment:
+                continue
+
+            segment_path = self._segment_path(segment_start)
+            if not os.path.exists(segment_path):
+                continue
+
+            with open(segment_path, 'rb') as fp:
+                fp.seek(offset if segment_start == first_segment else 0)
+                for _, payload in self._records(fp):
+                    yield Block.from_json(json.loads(payload))
+
+    def height(self):
+        """
+        The number of blocks in the store.
+        """
+        return self._height
+
+    def tip(self):
+        """
+        The last block stored, None if the store is empty.
+        """
+        return self._tip
+
+    def _sync(self):
+        """
+        Flushes the writer and the index, fsyncing the segment before the
+        index so an index entry never outlives its record.
+        """
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        self._unsynced = 0
+
+    def _rotate(self):
+        """
+        Seals the active segment and starts a new one at the current height.
+        """
+        self._sync()
+        self._writer.close()
+        self._segments.append(self._height)
+        self._writer = open(self._segment_path(self._height), 'ab')
+        logging.debug("New block segment started(height={})".
+                      format(self._height))
+
+    def _entry(self, height):
+        """
+        Reads the index entry of a height.
+
+        :returns a (segment, offset, length, digest) tuple.
+        """
+        if height < 0 or height >= self._height:
+            raise IndexError("No block at height {}".format(height))
+        entry_size = self.INDEX_ENTRY.size
+        index_map = self._map(None, (height + 1) * entry_size)
+        return self.INDEX_ENTRY.unpack_from(index_map, height * entry_size)
+
+    def _unmap(self, segment):
+        """
+        Drops the memory map of a segment, or of the index when segment is
+        None, before its file is truncated.
+        """
+        segment_map = self._maps.pop(segment, None)
+        if segment_map is not None:
+            segment_map.close()
+
+    def _entry_valid(self, height):
+        """
+        Checks that the record of an index entry is complete and intact.
+        """
+        segment, offset, length, _ = self._entry(height)
+        segment_path = self._segment_path(segment)
+        if not os.path.exists(segment_path):
+            return False
+        with open(segment_path, 'rb') as fp:
+            fp.seek(offset)
+            for _, payload in self._records(fp):
+                return len(payload) == length
+        return False
+
+    def _map(self, segment, size):
+        """
+        Obtains a memory map of a segment, or of the index when segment is
+        None, covering at least size bytes. Maps of files still growing are
+        replaced when a larger region is requested.
+        """
+        segment_map = self._maps.get(segment)
+        if segment_map is None or len(segment_map) < size:
+            with self._lock:
+                segment_map = self._maps.get(segment)
+                if segment_map is None or len(segment_map) < size:
+                    if segment is None:
+                        fileno = self._index.fileno()
+                    else:
+                        fp = open(self._segment_path(segment), 'rb')
+                        fileno = fp.fileno()
+                    self._maps[segment] = segment_map = \
+                        mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+                    if segment is not None:
+                        fp.close()
+        return segment_map
+
+    def _records(self, fp):
+        """
+        Iterates over the valid records of a segment. The iteration stops on
+        the first incomplete or corrupted record.
+
+        :returns a generator of (offset, payload) tuples.
+        """
+        header_size = self.RECORD_HEADER.size
+        while True:
+            offset = fp.tell()
+            header = fp.read(header_size)
+            if len(header) < header_size:
+                fp.seek(offset)
+                return
+            length, checksum = self.RECORD_HEADER.unpack(header)
+            payload = fp.read(length)
+            if len(payload) < length or \
+                    zlib.crc32(payload) & 0xffffffff != checksum:
+                fp.seek(offset)
+                return
+            yield offset, payload
+
+    def _segment_path(self, start):
+        return os.path.join(self._path, "{}{:012d}{}".format(
+            self.SEGMENT_PREFIX, start, self.SEGMENT_SUFFIX))
+
+    def _is_segment(self, name):
+        return name.startswith(self.SEGMENT_PREFIX) and \
+            name.endswith(self.SEGMENT_SUFFIX)
+
+    def _segment_start(self, name):
+        return int(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)])
@@ -0,0 +1,129 @@
+import binascii
+import hashlib
+import json
+import logging
+import os
+
+
+class CheckpointStore(object):
+    """
+    A CheckpointStore persists snapshots of the state derived from the
+    blockchain: the balances, the spent transactions, by txid and by spend
+    id, the height and the digest of the last block applied. A node restarts
+    from the newest valid checkpoint and only replays the blocks stored after
+    it.
+
+    Every checkpoint is a JSON file written to a temporary file, synced and
+    renamed over its final name, so a crash never leaves a partial
+    checkpoint behind. A checksum of the content guards against corruption.
+    """
+
+    PREFIX = "checkpoint-"
+    SUFFIX = ".json"
+    DEFAULT_KEEP = 2
+
+    def __init__(self, path, keep=DEFAULT_KEEP):
+        """
+        Instantiates a checkpoint store.
+
+        :param path: the directory where the checkpoints are kept.
+        :param keep: the number of checkpoints kept, older ones are removed.
+        """
+        self._path = path
+        self._keep = keep
+
+    def write(self, height, tip, balances, spent, spent_ids):
+        """
+        Writes a checkpoint atomically.
+
+        :param height: the number of blocks applied to the state.
+        :param tip: the raw digest of the last block applied.
+        :param balances: the balances by address.
+        :param spent: the heights of the blocks that included the spent
+                transactions, by txid.
+        :param spent_ids: the spend ids of the spent transactions.
+        """
+        logging.debug("Writing checkpoint(height={})".format(height))
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+        state = {
+            'height': height,
+            'tip': binascii.b2a_base64(tip),
+            'balances': balances,
+            'spent': spent,
+            'spent_ids': sorted(spent_ids)
+        }
+        checkpoint = {
+            'state': state,
+            'checksum': self._checksum(state)
+        }
+
+        path = self._checkpoint_path(height)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, 'wb') as fp:
+            json.dump(checkpoint, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(temporary_path, path)
+        self._sync_directory()
+
+        for old_height in self._heights()[:-self._keep]:
+            os.remove(self._checkpoint_path(old_height))
+
+    def newest(self, accept):
+        """
+        Finds the newest valid checkpoint.
+
+        :param accept: a function called with the height and raw tip digest of
+                a checkpoint, it must return True if the blockchain still holds
+                that block at that height.
+
+        :returns a dictionary with the height, tip, balances, spent and
+                 spent_ids of the checkpoint, or None if there is no valid
+                 checkpoint. Checkpoints written before the spend ids were
+                 kept are not valid, the blocks are replayed instead.
+        """
+        for height in reversed(self._heights()):
+            path = self._checkpoint_path(height)
+            try:
+                with open(path, 'rb') as fp:
+                    checkpoint = json.load(fp)
+                state = checkpoint['state']
+                assert checkpoint['checksum'] == self._checksum(state)
+                assert state['height'] == height
+                assert isinstance(state['spent'], dict)
+                assert isinstance(state['spent_ids'], list)
+                state['tip'] = binascii.a2b_base64(state['tip'])
+                assert accept(height, state['tip'])
+                return state
+            except (ValueError, KeyError, AssertionError, IOError):
+                logging.warn("Ignoring invalid checkpoint({})".format(path))
+
+        return None
+
+    def _heights(self):
+        if not os.path.isdir(self._path):
+            return []
+        return sorted(int(name[len(self.PREFIX):-len(self.SUFFIX)])
+                      for name in os.listdir(self._path)
+                      if name.startswith(self.PREFIX) and
+                      name.endswith(self.SUFFIX))
+
+    def _checkpoint_path(self, height):
+        return os.path.join(self._path, "{}{:012d}{}".format(
+            self.PREFIX, height, self.SUFFIX))
+
+    def _sync_directory(self):
+        """
+        Syncs the directory so the rename survives a crash.
+        """
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _checksum(state):
+        return hashlib.sha256(json.dumps(state, sort_keys=True)).hexdigest()
@@ -7,11 +7,12 @@ import threading
 import time
 from cmd import Cmd
 
-from block import Block
 from miner import Miner
 from node import Network, Node
 from quantcoin import QuantCoin
+from sync import Synchronizer
 from transaction import Transaction
+from validation import ChainVerifier
 
 
 class Client(Cmd):
@@ -23,7 +24,7 @@ class Client(Cmd):
     prompt = "[QuantCoin Shell]$ "
     intro = "Wellcome to QuantCoin shell. Type 'help' to get started."
 
-    def __init__(self, quantcoin, ip, port):
+    def __init__(self, quantcoin, ip, port, verifier=None):
         """
         Instantiates the Client Shell and setups the Node and the Network
         interface. The ip and port parameter will be used to register this
@@ -33,14 +34,17 @@ class Client(Cmd):
         :param quantcoin: The QuanCoin storages facade.
         :param ip: This client public IP address.
         :param port: The port that this client will operate.
+        :param verifier: The ChainVerifier checking the blocks received.
         """
         Cmd.__init__(self)
         self._node_data_lock = threading.Lock()
-        self._block_data_lock = threading.Lock()
 
         self._quantcoin = quantcoin
         self._quantcoin.store_node((ip, port))
+        self._verifier = verifier if verifier is not None else ChainVerifier()
         self._network = Network(quantcoin)
+        self._synchronizer = Synchronizer(quantcoin, self._network,
+                                          self._verifier)
         thread.start_new_thread(self._update_job, (ip, port))
 
     def emptyline(self):
@@ -83,7 +87,7 @@ class Client(Cmd):
         \t\tAsks the client for a manual update. The parameters allowed are
         \t\tp(eers) and b(locks). "peers" parameter updates the peers asking
         \t\tother nodes  in the network for it's know peers. "blocks" updates
-        \t\tthe blockchain.
+        \t\tthe blockchain, downloading only the blocks it lacks.
 
         \tsend <my_address> <commission> (<to_address> <amount>)+
         \t\tAnnounces a transference to the network so miners include it in the
@@ -162,15 +166,6 @@ class Client(Cmd):
             self._quantcoin.store_node(tuple(node))
         self._node_data_lock.release()
 
-    def _blocks_data_handler(self, block_data, socket):
-        """
-        Handles the block data received from the network.
-        """
-        self._block_data_lock.acquire()
-        for block in block_data:
-            self._quantcoin.store_block(Block.from_json(block))
-        self._block_data_lock.release()
-
     def do_update(self, line):
         """
         Manually updates the public storage.
@@ -178,7 +173,7 @@ class Client(Cmd):
         if line in ("p", "peers"):
             self._network.get_nodes(self._nodes_data_handler)
         if line in ("b", "blocks"):
-            self._network.get_blocks(self._blocks_data_handler)
+            self._synchronizer.sync()
 
     def do_send(self, line):
         """
@@ -247,17 +242,27 @@ def print_help():
           "\t\twill be used as the author of the blocks.")
     print("\t\t-P <password> The password that should be used to open the" +
           " private database.")
+    print("\t\t-w(--workers) <value>\tDefines the number of processes " +
+          "used to mine")
+    print("\t\t-v(--validation_workers) <value>\tDefines the number of " +
+          "processes used to verify the signatures of new blocks")
+    print("\t\t-c(--check)\t\t\tVerifies the stored blocks when loading " +
+          "the public storage")
+    print("\t\t-a(--assume_valid) <digest>\tSkips the signature checks of " +
+          "the blocks up to this block when verifying a chain")
 
 
 if __name__ == "__main__":
     try:
         application_args = sys.argv[1:]
         opts, _ = getopt.getopt(application_args,
-                                "hi:p:ds:x:m:P:",
+                                "hi:p:ds:x:m:P:w:v:ca:",
                                 ["help", "ip:", "port:",
                                  "debug", "storage:",
                                  "private_storage:", "mine:",
-                                 "password:"])
+                                 "password:", "workers:",
+                                 "validation_workers:", "check",
+                                 "assume_valid:"])
     except getopt.GetoptError:
         print_help()
         exit()
@@ -270,6 +275,10 @@ if __name__ == "__main__":
     miner = False
     miner_wallet = ''
     password = None
+    workers = 1
+    validation_workers = 1
+    check = False
+    assume_valid = None
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             print_help()
@@ -289,6 +298,14 @@ if __name__ == "__main__":
             miner_wallet = arg
         elif opt in ('-P', '--password'):
             password = arg
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-v', '--validation_workers'):
+            validation_workers = int(arg)
+        elif opt in ('-c', '--check'):
+            check = True
+        elif opt in ('-a', '--assume_valid'):
+            assume_valid = arg
 
     if debug:
         import logging
@@ -305,8 +322,9 @@ if __name__ == "__main__":
         root.addHandler(channel)
         print("Debug mode on.")
 
+    verifier = ChainVerifier(validation_workers, assume_valid=assume_valid)
     quantcoin = QuantCoin()
-    quantcoin.load(database)
+    quantcoin.load(database, verifier=verifier if check else None)
     quantcoin.database = database
     if password is None:
         password = getpass.getpass("Password for private storage: ")
@@ -314,22 +332,24 @@ if __name__ == "__main__":
     quantcoin.private_database = private_database
     quantcoin.password = password
     if miner:
-        miner = Miner(miner_wallet, quantcoin, ip, port)
+        miner = Miner(miner_wallet, quantcoin, ip, port, workers=workers,
+                      validation_workers=validation_workers)
         miner_network_thread = threading.Thread(target=miner.run)
         miner_network_thread.start()
         miner_thread = threading.Thread(target=miner.mine)
         miner_thread.start()
-        client = Client(quantcoin, ip, port)
+        client = Client(quantcoin, ip, port, verifier)
         client.cmdloop()
         miner.stop_mining()
         miner.stop()
         miner_thread.join()
         miner_network_thread.join()
     else:
-        node = Node(quantcoin, ip, port)
+        node = Node(quantcoin, ip, port,
+                    validation_workers=validation_workers)
         node_thread = threading.Thread(target=node.run)
         node_thread.start()
-        client = Client(quantcoin, ip, port)
+        client = Client(quantcoin, ip, port, verifier)
         client.cmdloop()
         node.stop()
         node_thread.join()
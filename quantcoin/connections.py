@@ -0,0 +1,215 @@
+import collections
+import json
+import logging
+import select
+import socket
+import threading
+import time
+
+import framing
+
+
+class ConnectionPool(object):
+    """
+    A ConnectionPool keeps long lived connections to the peers, so the
+    commands sent to a peer reuse a few connections instead of paying a TCP
+    handshake, and leaving a socket in TIME_WAIT, for each one.
+
+    A connection is used by one command at a time, the commands sent to a
+    peer are multiplexed over its idle connections. Connections idle for too
+    long are closed, and an idle connection is checked before being reused,
+    a connection the peer closed is readable. A peer that cannot be reached
+    is not tried again until a backoff, doubled on every failure, expires.
+
+    A new connection starts with a hello negotiating the compression of the
+    frames. A peer that closes the connection on the hello, not knowing the
+    command, is remembered and its next connections skip it.
+    """
+
+    DEFAULT_MAX_IDLE = 2
+    DEFAULT_IDLE_TIMEOUT = 60.0
+    DEFAULT_CONNECT_TIMEOUT = 5.0
+    DEFAULT_TIMEOUT = 30.0
+    BACKOFF = 1.0
+    MAX_BACKOFF = 300.0
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 timeout=DEFAULT_TIMEOUT,
+                 compression_level=framing.DEFAULT_COMPRESSION_LEVEL,
+                 compression_threshold=framing.DEFAULT_COMPRESSION_THRESHOLD):
+        """
+        Instantiates a connection pool.
+
+        :param max_idle: the maximum number of idle connections kept by peer.
+        :param idle_timeout: the time an idle connection is kept, in seconds.
+        :param connect_timeout: the time to establish a connection, in seconds.
+        :param timeout: the time a connection waits for a peer to read or
+                write data, in seconds.
+        :param compression_level: the zlib level of the frames compressed,
+                None if the compression is not offered to the peers.
+        :param compression_threshold: the size of the smallest frame
+                compressed, in bytes.
+        """
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        self._connect_timeout = connect_timeout
+        self._timeout = timeout
+        self._compression_level = compression_level
+        self._compression_threshold = compression_threshold
+        self._uncompressed = set()
+        self._idle = collections.defaultdict(list)
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, address):
+        """
+        Obtains a connection to a peer, reusing an idle one if there is one
+        still healthy.
+
+        :param address: the (ip, port) of the peer.
+
+        :returns a (connection, reused) tuple, None if the peer cannot be
+                 reached or is backing off.
+        """
+        address = tuple(address)
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(address)
+            while idle:
+                connection, released = idle.pop()
+                if now - released <= self._idle_timeout and \
+                        self._healthy(connection):
+                    return connection, True
+                connection.close()
+
+            failure = self._failures.get(address)
+            if failure is not None and now < failure[1]:
+                return None
+
+        try:
+            connection = socket.create_connection(address,
+                                                  self._connect_timeout)
+        except (socket.error, OverflowError, TypeError) as e:
+            self.failed(address)
+            logging.debug("Peer unreachable(address={}). {}".
+                          format(address, e))
+            return None
+
+        connection.settimeout(self._timeout)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self._lock:
+            self._failures.pop(address, None)
+        if self._compression_level is not None and \
+                address not in self._uncompressed:
+            try:
+                if not self._hello(address, connection):
+                    return self.acquire(address)
+            except (socket.error, framing.FramingError, ValueError) as e:
+                connection.close()
+                self.failed(address)
+                logging.debug("Hello failed(address={}). {}".
+                              format(address, e))
+                return None
+        return connection, False
+
+    def _hello(self, address, connection):
+        """
+        Negotiates the compression of a new connection.
+
+        :returns False if the peer closed the connection, it is then not
+                 offered compression again.
+        """
+        framing.send_frame(connection, json.dumps({
+            'cmd': 'hello',
+            'compression': [framing.Compression.ALGORITHM]
+        }))
+        response = framing.recv_frame(connection)
+        if response is None:
+            connection.close()
+            with self._lock:
+                self._uncompressed.add(address)
+            return False
+
+        if json.loads(response).get('compression') == \
+                framing.Compression.ALGORITHM:
+            framing.enable_compression(connection, framing.Compression(
+                connection.getpeername()[0], self._compression_level,
+                self._compression_threshold))
+        return True
+
+    def release(self, address, connection, reusable=True):
+        """
+        Gives back a connection after a command, keeping it for the next ones.
+
+        :param reusable: False if the command failed and the connection must
+                be closed.
+        """
+        address = tuple(address)
+        with self._lock:
+            idle = self._idle[address]
+            if reusable and len(idle) < self._max_idle:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def failed(self, address):
+        """
+        Records a failure to reach a peer, delaying the next attempt.
+        """
+        address = tuple(address)
+        with self._lock:
+            failures = self._failures.get(address, (0, 0))[0] + 1
+            backoff = min(self.BACKOFF * 2 ** (failures - 1), self.MAX_BACKOFF)
+            self._failures[address] = (failures, time.time() + backoff)
+
+    def close_idle(self):
+        """
+        Closes the connections idle for longer than the idle timeout.
+        """
+        now = time.time()
+        with self._lock:
+            for address, idle in self._idle.items():
+                kept = []
+                for connection, released in idle:
+                    if now - released <= self._idle_timeout:
+                        kept.append((connection, released))
+                    else:
+                        connection.close()
+                if kept:
+                    self._idle[address] = kept
+                else:
+                    del self._idle[address]
+
+    def close(self):
+        """
+        Closes every idle connection.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for connection, _ in idle:
+                    connection.close()
+            self._idle.clear()
+
+    def idle(self):
+        """
+        The number of idle connections kept.
+        """
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    @staticmethod
+    def _healthy(connection):
+        """
+        An idle connection has nothing to read, unless the peer closed it or
+        sent data out of turn.
+        """
+        try:
+            readable, _, _ = select.select([connection], [], [], 0)
+        except (socket.error, select.error, ValueError):
+            return False
+        return not readable
+
+
+connection_pool = ConnectionPool()
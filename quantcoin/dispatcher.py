@@ -0,0 +1,87 @@
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+class Dispatcher(object):
+    """
+    A Dispatcher runs the requests sent to the peers in a bounded pool of
+    threads, instead of a new thread for each one, so a burst of broadcasts
+    or a few dead peers cannot pile up threads.
+
+    A request is identified by a key. A request identical to one still
+    queued or running is merged into it, so the same command is not sent
+    twice to a peer while the first one has not completed.
+    """
+
+    DEFAULT_WORKERS = 16
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        """
+        Instantiates a dispatcher.
+
+        :param workers: the number of threads sending requests.
+        """
+        self._workers = workers
+        self._executor = None
+        self._pending = set()
+        self._merged = 0
+        self._lock = threading.Lock()
+
+    def submit(self, key, function, *args):
+        """
+        Schedules a request.
+
+        :param key: the identity of the request, None if it is never merged.
+        :param function: the function sending the request, called with args.
+
+        :returns True if the request was scheduled, False if it was merged
+                 into an identical pending one.
+        """
+        with self._lock:
+            if key is not None:
+                if key in self._pending:
+                    self._merged += 1
+                    return False
+                self._pending.add(key)
+            if self._executor is None:
+                self._executor = ThreadPool(self._workers)
+            self._executor.apply_async(self._run, (key, function, args))
+        return True
+
+    def pending(self):
+        """
+        The number of requests queued or running, among the ones that can be
+        merged.
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def merged(self):
+        """
+        The number of requests merged into identical pending ones.
+        """
+        return self._merged
+
+    def close(self):
+        """
+        Stops the threads once the scheduled requests are sent.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.close()
+            executor.join()
+
+    def _run(self, key, function, args):
+        try:
+            function(*args)
+        except Exception as e:
+            logging.debug("Request failed. {}".format(e))
+        finally:
+            if key is not None:
+                with self._lock:
+                    self._pending.discard(key)
+
+
+request_dispatcher = Dispatcher()
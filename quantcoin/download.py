@@ -0,0 +1,243 @@
+import collections
+import logging
+import threading
+import time
+
+
+class DownloadScheduler(object):
+    """
+    A DownloadScheduler downloads a range of blocks from several peers at
+    once. The range is split in chunks of consecutive blocks and every peer
+    fetches chunks one after the other, the lowest ones first, so the time to
+    download grows with the range divided by the number of peers.
+
+    The chunks are validated in height order, a chunk received before the
+    ones below it waits for them, and the peers do not fetch chunks further
+    than a window above the last validated one. A chunk that fails is fetched
+    again from another peer, and a chunk fetched for longer than the stall
+    timeout is fetched as well by an idle peer, the first copy received being
+    kept. A peer failing too many times, or sending an invalid chunk, is not
+    used anymore.
+
+    The peers are served by the threads calling work, a peer may join while
+    the download is running and extend the range with the blocks it has.
+    """
+
+    DEFAULT_CHUNK_SIZE = 100
+    DEFAULT_STALL_TIMEOUT = 10.0
+    DEFAULT_WINDOW = 4
+    DEFAULT_MAX_FAILURES = 3
+    WAIT_INTERVAL = 1.0
+
+    def __init__(self, fetch, deliver, start, chunk_size=DEFAULT_CHUNK_SIZE,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT, window=DEFAULT_WINDOW,
+                 max_failures=DEFAULT_MAX_FAILURES):
+        """
+        Instantiates a download scheduler.
+
+        :param fetch: the function fetching a chunk, called with the peer and
+                the start and end heights of the chunk. It returns the blocks
+                data and raises an exception on failure.
+        :param deliver: the function validating and storing the blocks data of
+                a chunk, called in height order with the height of the first
+                block and the blocks data. It returns False if the blocks are
+                invalid.
+        :param start: the height of the first block to be downloaded.
+        :param chunk_size: the number of blocks of a chunk.
+        :param stall_timeout: the time a chunk is fetched from a single peer
+                before another one fetches it as well, in seconds.
+        :param window: the number of chunks by peer fetched ahead of the last
+                validated one.
+        :param max_failures: the number of failed chunks after which a peer
+                is not used anymore.
+        """
+        self._fetch = fetch
+        self._deliver = deliver
+        self._chunk_size = chunk_size
+        self._stall_timeout = stall_timeout
+        self._window = window
+        self._max_failures = max_failures
+        self._delivered = start
+        self._end = start
+        self._chunks = {}
+        self._queued = set()
+        self._fetching = {}
+        self._completed = {}
+        self._tried = collections.defaultdict(set)
+        self._failures = collections.defaultdict(int)
+        self._peers = {}
+        self._condition = threading.Condition()
+        self._delivery_lock = threading.Lock()
+
+    def add_peer(self, peer, height):
+        """
+        Adds a peer to the download, the range is extended up to its height.
+        The peer is then served by calling work.
+
+        :param peer: the identity of the peer, passed to the fetch function.
+        :param height: the number of blocks of the peer.
+        """
+        with self._condition:
+            self._peers[peer] = height
+            if height > self._end:
+                for start in xrange(self._end, height, self._chunk_size):
+                    self._chunks[start] = min(start + self._chunk_size, height)
+                    self._queued.add(start)
+                self._end = height
+            self._condition.notify_all()
+
+    def work(self, peer):
+        """
+        Fetches chunks from a peer added to the download until none is left
+        that the peer can serve.
+
+        :returns the number of chunks fetched from the peer.
+        """
+        fetched = 0
+        try:
+            while True:
+                with self._condition:
+                    chunk = self._take(peer)
+                    while chunk is None:
+                        if not self._can_serve(peer):
+                            return fetched
+                        self._condition.wait(self.WAIT_INTERVAL)
+                        chunk = self._take(peer)
+
+                start, end = chunk
+                try:
+                    blocks = self._fetch(peer, start, end)
+                    if len(blocks) != end - start:
+                        raise Exception("Chunk incomplete({} blocks)".
+                                        format(len(blocks)))
+                except Exception as e:
+                    logging.debug("Chunk failed(start={}, end={}). {}".
+                                  format(start, end, e))
+                    with self._condition:
+                        self._failed(peer, start)
+                    continue
+
+                fetched += 1
+                with self._condition:
+                    self._complete(peer, start, blocks)
+                self._deliver_completed()
+        finally:
+            with self._condition:
+                self._peers.pop(peer, None)
+                self._condition.notify_all()
+
+    def delivered(self):
+        """
+        The height up to which the blocks were validated.
+        """
+        return self._delivered
+
+    def done(self):
+        """
+        True if every block of the range was validated.
+        """
+        return self._delivered >= self._end
+
+    def peers(self):
+        """
+        The number of peers being served.
+        """
+        with self._condition:
+            return len(self._peers)
+
+    def _take(self, peer):
+        """
+        Assigns to a peer the lowest chunk waiting, or a stalled one, within
+        the window and the height of the peer.
+
+        :returns the (start, end) of the chunk, None if there is none.
+        """
+        height = self._peers[peer]
+        if self._failures[peer] >= self._max_failures:
+            return None
+        limit = self._delivered + \
+            self._window * self._chunk_size * len(self._peers)
+        now = time.time()
+
+        for start in sorted(self._queued):
+            if start >= limit:
+                break
+            if self._chunks[start] <= height and \
+                    peer not in self._tried[start]:
+                self._queued.remove(start)
+                self._fetching[start] = {peer: now}
+                return start, self._chunks[start]
+
+        for start in sorted(self._fetching):
+            fetchers = self._fetching[start]
+            if peer not in fetchers and peer not in self._tried[start] and \
+                    self._chunks[start] <= height and \
+                    now - min(fetchers.values()) > self._stall_timeout:
+                logging.debug("Chunk stalled(start={})".format(start))
+                fetchers[peer] = now
+                return start, self._chunks[start]
+        return None
+
+    def _can_serve(self, peer):
+        """
+        True if a chunk not yet received may still be fetched from a peer.
+        """
+        if self.done() or self._failures[peer] >= self._max_failures:
+            return False
+        height = self._peers[peer]
+        return any(self._chunks[start] <= height and
+                   peer not in self._tried[start]
+                   for start in list(self._queued) + list(self._fetching))
+
+    def _failed(self, peer, start):
+        self._failures[peer] += 1
+        self._tried[start].add(peer)
+        fetchers = self._fetching.get(start)
+        if fetchers is not None:
+            fetchers.pop(peer, None)
+            if not fetchers:
+                del self._fetching[start]
+                self._queued.add(start)
+        self._condition.notify_all()
+
+    def _complete(self, peer, start, blocks):
+        # Another peer may have sent the chunk first
+        if start in self._fetching:
+            del self._fetching[start]
+            self._completed[start] = (peer, blocks)
+
+    def _deliver_completed(self):
+        """
+        Validates the chunks received, in height order. A single thread
+        validates at a time, the others return to fetching.
+        """
+        while self._delivery_lock.acquire(False):
+            try:
+                while True:
+                    with self._condition:
+                        start = self._delivered
+                        completed = self._completed.pop(start, None)
+                    if completed is None:
+                        break
+
+                    peer, blocks = completed
+                    valid = self._deliver(start, blocks)
+                    with self._condition:
+                        if valid:
+                            self._delivered = self._chunks.pop(start)
+                            self._tried.pop(start, None)
+                        else:
+                            logging.debug("Invalid chunk(start={})".
+                                          format(start))
+                            self._failures[peer] = self._max_failures
+                            self._tried[start].add(peer)
+                            self._queued.add(start)
+                        self._condition.notify_all()
+            finally:
+                self._delivery_lock.release()
+
+            # A chunk completed while the lock was being released would wait
+            # for the next one otherwise
+            with self._condition:
+                if self._delivered not in self._completed:
+                    return
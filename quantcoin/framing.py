@@ -0,0 +1,353 @@
+import collections
+import struct
+import threading
+import weakref
+import zlib
+
+# Every frame is its payload size, in network byte order, and the payload.
+# The highest bit of the size is set when the payload is compressed.
+HEADER = struct.Struct("!I")
+COMPRESSED = 0x80000000
+MAX_FRAME_SIZE = 32 * 1024 * 1024
+COALESCE_SIZE = 64 * 1024
+
+DEFAULT_COMPRESSION_LEVEL = 6
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+
+class FramingError(Exception):
+    """
+    Raised when the frames of a connection cannot be read, as when a frame is
+    truncated or larger than allowed.
+    """
+    pass
+
+
+class Traffic(object):
+    """
+    Traffic counts the bytes of the frames exchanged with each peer over
+    connections using compression, both before compression and as sent on
+    the wire, so the savings of the compression can be seen.
+    """
+
+    def __init__(self):
+        self._peers = collections.defaultdict(lambda: [0, 0, 0, 0])
+        self._lock = threading.Lock()
+
+    def sent(self, peer, raw, compressed):
+        """
+        Counts a frame sent to a peer.
+        """
+        with self._lock:
+            counters = self._peers[peer]
+            counters[0] += raw
+            counters[1] += compressed
+
+    def received(self, peer, raw, compressed):
+        """
+        Counts a frame received from a peer.
+        """
+        with self._lock:
+            counters = self._peers[peer]
+            counters[2] += raw
+            counters[3] += compressed
+
+    def peers(self):
+        """
+        The bytes exchanged with each peer.
+
+        :returns a dict of dicts with the sent_raw, sent_compressed,
+                 received_raw and received_compressed bytes, by peer.
+        """
+        with self._lock:
+            return dict((peer, {'sent_raw': counters[0],
+                                'sent_compressed': counters[1],
+                                'received_raw': counters[2],
+                                'received_compressed': counters[3]})
+                        for peer, counters in self._peers.items())
+
+
+traffic = Traffic()
+
+
+class Compression(object):
+    """
+    The compression negotiated on a connection. The payloads above the
+    threshold are compressed with zlib, unless they do not get smaller.
+    """
+
+    ALGORITHM = "zlib"
+
+    def __init__(self, peer, level=DEFAULT_COMPRESSION_LEVEL,
+                 threshold=DEFAULT_COMPRESSION_THRESHOLD, counters=traffic):
+        """
+        Instantiates the compression of a connection.
+
+        :param peer: the peer of the connection, the key of its counters.
+        :param level: the zlib compression level, from 1 to 9.
+        :param threshold: the size of the smallest payload compressed, in
+                bytes.
+        :param counters: the Traffic counting the bytes exchanged.
+        """
+        self.peer = peer
+        self.level = level
+        self.threshold = threshold
+        self.counters = counters
+
+    def compress(self, payload):
+        """
+        Compresses a payload to be sent.
+
+        :returns a (compressed, data) tuple, compressed being False if the
+                 data is the payload itself.
+        """
+        data = payload
+        compressed = False
+        if len(payload) >= self.threshold:
+            deflated = zlib.compress(str(payload), self.level)
+            if len(deflated) < len(payload):
+                data = deflated
+                compressed = True
+        self.counters.sent(self.peer, len(payload), len(data))
+        return compressed, data
+
+    def decompress(self, compressed, data):
+        """
+        Restores a payload received.
+
+        :raises FramingError: if the data cannot be decompressed or is larger
+                than a frame when decompressed.
+        """
+        payload = data
+        if compressed:
+            decompressor = zlib.decompressobj()
+            try:
+                payload = decompressor.decompress(data, MAX_FRAME_SIZE)
+            except zlib.error as e:
+                raise FramingError("Invalid compressed frame. {}".format(e))
+            if decompressor.unconsumed_tail:
+                raise FramingError("Frame too large when decompressed")
+        self.counters.received(self.peer, len(payload), len(data))
+        return payload
+
+
+# The compression negotiated on the blocking connections, by connection
+_compressions = weakref.WeakKeyDictionary()
+_compressions_lock = threading.Lock()
+
+
+def enable_compression(connection, compression):
+    """
+    Compresses the frames sent over a blocking connection from now on, and
+    accepts compressed frames from it.
+
+    :param compression: the Compression negotiated, None to disable it.
+    """
+    with _compressions_lock:
+        if compression is None:
+            _compressions.pop(connection, None)
+        else:
+            _compressions[connection] = compression
+
+
+def compression_of(connection):
+    """
+    Obtains the compression negotiated on a blocking connection.
+
+    :returns the Compression, None if the frames are not compressed.
+    """
+    with _compressions_lock:
+        return _compressions.get(connection)
+
+
+def encode(payload, compression=None):
+    """
+    Builds the frame of a payload.
+
+    :param compression: the Compression of the connection, None if the
+            payload is not to be compressed.
+    """
+    compressed = False
+    if compression is not None:
+        compressed, payload = compression.compress(payload)
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FramingError("Frame too large({} bytes)".format(len(payload)))
+    return _header(len(payload), compressed) + str(payload)
+
+
+def send_frame(connection, payload):
+    """
+    Writes a whole frame to a blocking connection, compressed if the
+    connection negotiated it.
+
+    :param payload: a string or a buffer.
+    """
+    compressed = False
+    compression = compression_of(connection)
+    if compression is not None:
+        compressed, payload = compression.compress(payload)
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FramingError("Frame too large({} bytes)".format(len(payload)))
+    # Small frames are written at once, a separate header would wait for the
+    # acknowledgement of the peer
+    if len(payload) <= COALESCE_SIZE:
+        connection.sendall(_header(len(payload), compressed) + str(payload))
+    else:
+        connection.sendall(_header(len(payload), compressed))
+        connection.sendall(payload)
+
+
+def send_frames(connection, payloads):
+    """
+    Writes a stream of frames to a blocking connection, ended by an empty
+    frame.
+
+    :param payloads: an iterable of non empty payloads.
+    """
+    for payload in payloads:
+        send_frame(connection, payload)
+    send_frame(connection, '')
+
+
+def recv_frame(connection):
+    """
+    Reads a whole frame from a blocking connection.
+
+    :returns the payload, None if the connection was closed before a frame
+             started.
+    :raises FramingError: if the frame is too large or the connection is
+            closed in the middle of it.
+    """
+    header = _recv_exactly(connection, HEADER.size, True)
+    if header is None:
+        return None
+    compressed, size = _parse_header(header)
+    payload = _recv_exactly(connection, size, False)
+    compression = compression_of(connection)
+    if compression is not None:
+        return compression.decompress(compressed, payload)
+    if compressed:
+        raise FramingError("Compressed frame on a connection without "
+                           "compression")
+    return payload
+
+
+def recv_frames(connection):
+    """
+    Reads a stream of frames written by send_frames.
+
+    :returns a generator of the payloads, the empty frame ending the stream
+             excluded.
+    :raises FramingError: if the stream ends before its empty frame.
+    """
+    while True:
+        payload = recv_frame(connection)
+        if payload is None:
+            raise FramingError("Connection closed in a stream of frames")
+        if payload == '':
+            return
+        yield payload
+
+
+def _header(size, compressed):
+    return HEADER.pack(size | COMPRESSED if compressed else size)
+
+
+def _parse_header(header, max_frame_size=MAX_FRAME_SIZE):
+    """
+    :returns a (compressed, size) tuple.
+    """
+    size = HEADER.unpack_from(header)[0]
+    compressed = bool(size & COMPRESSED)
+    size &= ~COMPRESSED
+    if size > max_frame_size:
+        raise FramingError("Frame too large({} bytes)".format(size))
+    return compressed, size
+
+
+def _recv_exactly(connection, size, at_boundary):
+    chunks = []
+    received = 0
+    while received < size:
+        chunk = connection.recv(min(size - received, 1024 * 1024))
+        if not chunk:
+            if at_boundary and received == 0:
+                return None
+            raise FramingError("Connection closed in the middle of a frame")
+        chunks.append(chunk)
+        received += len(chunk)
+    return ''.join(chunks)
+
+
+class FrameDecoder(object):
+    """
+    A FrameDecoder parses frames incrementally from the data of a
+    non-blocking connection, whatever the way the data was split.
+
+    The compressed frames are accepted once the compression of the
+    connection is set.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        """
+        Instantiates a frame decoder.
+
+        :param max_frame_size: the size of the largest payload accepted.
+        """
+        self._max_frame_size = max_frame_size
+        self._chunks = []
+        self._buffered = 0
+        self._size = None
+        self._compressed = False
+        self.compression = None
+
+    def feed(self, data):
+        """
+        Adds data received from the connection.
+
+        :returns the payloads of the frames completed by the data.
+        :raises FramingError: if a frame is larger than allowed.
+        """
+        self._chunks.append(data)
+        self._buffered += len(data)
+        frames = []
+        while True:
+            if self._size is None:
+                if self._buffered < HEADER.size:
+                    break
+                buffered = self._join()
+                self._compressed, self._size = _parse_header(
+                    buffered, self._max_frame_size)
+                if self._compressed and self.compression is None:
+                    raise FramingError("Compressed frame on a connection "
+                                       "without compression")
+                self._consume(buffered, HEADER.size)
+
+            if self._buffered < self._size:
+                break
+            buffered = self._join()
+            payload = buffered[:self._size]
+            if self.compression is not None:
+                payload = self.compression.decompress(self._compressed,
+                                                      payload)
+            frames.append(payload)
+            self._consume(buffered, self._size)
+            self._size = None
+
+        return frames
+
+    def buffered(self):
+        """
+        The number of bytes received that do not complete a frame yet.
+        """
+        return self._buffered
+
+    def _join(self):
+        buffered = ''.join(self._chunks)
+        self._chunks = [buffered]
+        return buffered
+
+    def _consume(self, buffered, size):
+        rest = buffered[size:]
+        self._chunks = [rest] if rest else []
+        self._buffered = len(rest)
@@ -0,0 +1,104 @@
+import collections
+import threading
+import time
+
+
+class Inventory(object):
+    """
+    An Inventory remembers the blocks and transactions a node has already
+    seen, by block digest or txid, so the same message reaching the node from
+    several peers is handled and relayed only once.
+
+    Peers announce the hashes of their new messages and send the bodies only
+    when asked for. The inventory also remembers the hashes recently asked
+    for, a hash announced by several peers at once is asked to only one of
+    them, unless its body does not arrive within the request timeout.
+
+    The transactions recently relayed are kept as well, the blocks announced
+    in compact form are rebuilt from them.
+
+    Every set is bounded and forgets the oldest entries first.
+    """
+
+    DEFAULT_SIZE = 50000
+    DEFAULT_REQUEST_TIMEOUT = 30.0
+    DEFAULT_TRANSACTIONS_SIZE = 20000
+
+    def __init__(self, size=DEFAULT_SIZE,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT,
+                 transactions_size=DEFAULT_TRANSACTIONS_SIZE):
+        """
+        Instantiates an inventory.
+
+        :param size: the maximum number of hashes kept in each set.
+        :param request_timeout: the time to wait for a body asked for before
+                asking another peer, in seconds.
+        :param transactions_size: the maximum number of relayed transactions
+                kept.
+        """
+        self._size = size
+        self._request_timeout = request_timeout
+        self._transactions_size = transactions_size
+        self._seen = collections.OrderedDict()
+        self._requested = collections.OrderedDict()
+        self._transactions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def mark_seen(self, key):
+        """
+        Records a message as seen.
+
+        :returns True if the message was not seen before.
+        """
+        with self._lock:
+            self._requested.pop(key, None)
+            if key in self._seen:
+                return False
+            self._seen[key] = True
+            while len(self._seen) > self._size:
+                self._seen.popitem(last=False)
+            return True
+
+    def seen(self, key):
+        """
+        True if the message was seen.
+        """
+        return key in self._seen
+
+    def want(self, key):
+        """
+        Decides if the body of an announced message must be asked for, and if
+        so records the request.
+
+        :returns True if the message was neither seen nor recently asked for.
+        """
+        now = time.time()
+        with self._lock:
+            if key in self._seen:
+                return False
+            requested = self._requested.pop(key, None)
+            if requested is not None and now - requested < \
+                    self._request_timeout:
+                self._requested[key] = requested
+                return False
+            self._requested[key] = now
+            while len(self._requested) > self._size:
+                self._requested.popitem(last=False)
+            return True
+
+    def add_transaction(self, transaction):
+        """
+        Keeps a relayed transaction.
+        """
+        with self._lock:
+            self._transactions[transaction.txid()] = transaction
+            while len(self._transactions) > self._transactions_size:
+                self._transactions.popitem(last=False)
+
+    def transaction(self, txid):
+        """
+        Obtains a relayed transaction.
+
+        :returns the transaction, None if it is not kept.
+        """
+        return self._transactions.get(txid)
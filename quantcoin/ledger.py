@@ -0,0 +1,148 @@
+import logging
+import threading
+
+
+class Ledger(object):
+    """
+    A Ledger keeps the balance of every address known in the blockchain. The
+    balances are updated once per accepted block, so the amount owned by a
+    wallet is known without walking the chain.
+
+    The rules applied are the same used to compute the amount owned from the
+    blocks: the author of a block earns every commission paid in it, a sender
+    loses the whole amount spent, commission included, and every receiver
+    earns the amount sent to it. Coin creation transactions have no sender.
+
+    The ledger also records every transaction spent in the blockchain and the
+    height of the block that included it, so its block is found without
+    walking the chain. A transaction included again is caught by its spend
+    id, which does not change when the transaction is re-encoded.
+    """
+
+    def __init__(self, balances=None, spent=None, height=0, spent_ids=None):
+        """
+        Instantiates a ledger.
+
+        :param balances: the initial balances, by address.
+        :param spent: the heights of the blocks that included the transactions
+                already spent, by txid.
+        :param height: the number of blocks already applied.
+        :param spent_ids: the spend ids of the transactions already spent.
+        """
+        self._balances = dict(balances) if balances is not None else {}
+        self._spent = dict(spent) if spent is not None else {}
+        self._spent_ids = set(spent_ids) if spent_ids is not None else set()
+        self._height = height
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_blocks(blocks):
+        """
+        Builds a ledger replaying a sequence of blocks from the genesis.
+
+        :param blocks: the blocks in the order they were accepted.
+        """
+        ledger = Ledger()
+        for block in blocks:
+            ledger.apply_block(block)
+        return ledger
+
+    def apply_block(self, block):
+        """
+        Updates the balances with the transactions of an accepted block.
+
+        :param block: the block accepted in the blockchain.
+        """
+        with self._lock:
+            commission = block.commission()
+            if commission != 0.0:
+                self._credit(block.author(), commission)
+
+            for transaction in block.transactions():
+                sender = transaction.from_wallet()
+                if sender is not None:
+                    self._credit(sender, -transaction.amount_spent())
+                    self._spent[transaction.txid()] = self._height
+                    self._spent_ids.add(transaction.spend_id())
+
+                for wallet, amount in transaction.to_wallets():
+                    # The commission has no wallet, it goes to the author
+                    if wallet is not None and wallet != sender:
+                        self._credit(wallet, amount)
+
+            self._height += 1
+
+    def balance(self, address):
+        """
+        The amount owned by an address.
+        """
+        return self._balances.get(address, 0.0)
+
+    def balances(self):
+        """
+        A copy of the balances of every address, by address.
+        """
+        with self._lock:
+            return dict(self._balances)
+
+    def height(self):
+        """
+        The number of blocks applied to the ledger.
+        """
+        return self._height
+
+    def spent(self):
+        """
+        A copy of the heights of the blocks that included the spent
+        transactions, by txid.
+        """
+        with self._lock:
+            return dict(self._spent)
+
+    def spent_ids(self):
+        """
+        A copy of the spend ids of the spent transactions.
+        """
+        with self._lock:
+            return set(self._spent_ids)
+
+    def is_spent(self, transaction):
+        """
+        True if the transaction was already included in the blockchain, in
+        this encoding or in any other.
+        """
+        return transaction.spend_id() in self._spent_ids
+
+    def spent_height(self, txid):
+        """
+        The height of the block that included a transaction.
+
+        :returns the height, None if the transaction was not spent.
+        """
+        return self._spent.get(txid)
+
+    def check(self, blocks):
+        """
+        Checks this ledger against one rebuilt from scratch.
+
+        :param blocks: the blocks of the blockchain, from the genesis.
+
+        :returns a dictionary, by address, of the (live, rebuilt) balances that
+                 differ. Empty if the ledger is consistent.
+        """
+        rebuilt = Ledger.from_blocks(blocks).balances()
+        live = self.balances()
+        mismatches = {}
+        for address in set(live.keys()) | set(rebuilt.keys()):
+            live_balance = live.get(address, 0.0)
+            rebuilt_balance = rebuilt.get(address, 0.0)
+            if live_balance != rebuilt_balance:
+                logging.warn("Ledger mismatch(address={}, live={}, "
+                             "rebuilt={})".format(address, live_balance,
+                                                  rebuilt_balance))
+                mismatches[address] = (live_balance, rebuilt_balance)
+
+        return mismatches
+
+    def _credit(self, address, amount):
+        self._balances[address] = self._balances.get(address, 0.0) + amount
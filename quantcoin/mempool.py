@@ -0,0 +1,192 @@
+import heapq
+import itertools
+import logging
+import threading
+
+
+class Mempool(object):
+    """
+    A Mempool holds the transactions waiting to be mined, ordered by the
+    commission they pay per byte of their canonical encoding. The pool is
+    bounded in number of transactions and in bytes, when it is full the
+    lowest paying transactions are evicted to make room for better ones.
+
+    Two heaps keep the order, one with the best paying transaction on top for
+    building blocks and one with the worst paying on top for eviction. Entries
+    removed from the pool are left in the heaps and skipped when they surface,
+    so admission, eviction and removal are O(log n).
+    """
+
+    DEFAULT_MAX_COUNT = 50000
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+    MAX_SKIPPED = 50
+
+    def __init__(self, max_count=DEFAULT_MAX_COUNT,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Instantiates a mempool.
+
+        :param max_count: the maximum number of transactions held.
+        :param max_bytes: the maximum size of the transactions held, in bytes.
+        """
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._entries = {}
+        self._best = []
+        self._worst = []
+        self._bytes = 0
+        self._commission = 0.0
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, transaction):
+        """
+        Admits a transaction in the pool, evicting the lowest paying ones if
+        the pool gets over its limits.
+
+        :param transaction: a verified transaction.
+
+        :returns True if the transaction was admitted, False if it was already
+                 in the pool, does not fit in it or pays less than every
+                 transaction of a full pool.
+        """
+        txid = transaction.txid()
+        size = len(transaction.serialize())
+        rate = float(transaction.commission()) / size
+        with self._lock:
+            if txid in self._entries or size > self._max_bytes:
+                return False
+
+            if self._full(size):
+                worst = self._peek(self._worst)
+                if worst is None or rate <= worst[0]:
+                    logging.debug("Mempool full, transaction rejected({})".
+                                  format(txid))
+                    return False
+
+            sequence = next(self._sequence)
+            self._entries[txid] = (rate, sequence, size, transaction)
+            heapq.heappush(self._best, (-rate, sequence, txid))
+            heapq.heappush(self._worst, (rate, -sequence, txid))
+            self._bytes += size
+            self._commission += transaction.commission()
+
+            while self._over_limits():
+                _, _, evicted = self._peek(self._worst)
+                logging.debug("Evicting transaction from mempool({})".
+                              format(evicted))
+                self._remove(evicted)
+
+            self._compact()
+            return txid in self._entries
+
+    def remove(self, txid):
+        """
+        Removes a transaction from the pool, if present.
+        """
+        with self._lock:
+            if txid in self._entries:
+                self._remove(txid)
+                self._compact()
+
+    def select(self, max_bytes):
+        """
+        Chooses the most profitable transactions fitting in a block. The
+        transactions are taken by commission per byte while they fit, those
+        too large for the space left are skipped.
+
+        :param max_bytes: the space available in the block, in bytes.
+
+        :returns the transactions chosen, best paying first.
+        """
+        with self._lock:
+            selected = []
+            popped = []
+            available = max_bytes
+            skipped = 0
+            while self._best and available > 0 and skipped < self.MAX_SKIPPED:
+                item = heapq.heappop(self._best)
+                entry = self._entries.get(item[2])
+                if entry is None or entry[1] != item[1]:
+                    continue
+                popped.append(item)
+                _, _, size, transaction = entry
+                if size <= available:
+                    selected.append(transaction)
+                    available -= size
+                else:
+                    skipped += 1
+
+            for item in popped:
+                heapq.heappush(self._best, item)
+
+            return selected
+
+    def get(self, txid):
+        """
+        Obtains a transaction of the pool.
+
+        :returns the transaction, None if it is not in the pool.
+        """
+        entry = self._entries.get(txid)
+        return entry[3] if entry is not None else None
+
+    def commission(self):
+        """
+        The sum of the commissions offered by the transactions in the pool.
+        """
+        return self._commission
+
+    def size_bytes(self):
+        """
+        The size of the transactions in the pool, in bytes.
+        """
+        return self._bytes
+
+    def __contains__(self, txid):
+        return txid in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _full(self, size):
+        return len(self._entries) + 1 > self._max_count or \
+            self._bytes + size > self._max_bytes
+
+    def _over_limits(self):
+        return len(self._entries) > self._max_count or \
+            self._bytes > self._max_bytes
+
+    def _remove(self, txid):
+        _, _, size, transaction = self._entries.pop(txid)
+        self._bytes -= size
+        self._commission -= transaction.commission()
+        if len(self._entries) == 0:
+            self._commission = 0.0
+
+    def _peek(self, heap):
+        """
+        Drops the stale items on top of a heap and returns the top one, None
+        if the heap is empty.
+        """
+        while heap:
+            item = heap[0]
+            entry = self._entries.get(item[2])
+            if entry is not None and entry[1] == abs(item[1]):
+                return item
+            heapq.heappop(heap)
+        return None
+
+    def _compact(self):
+        """
+        Rebuilds the heaps when most of their items are stale.
+        """
+        if len(self._best) > 2 * len(self._entries) + 64:
+            self._best = [(-rate, sequence, txid)
+                          for txid, (rate, sequence, _, _)
+                          in self._entries.items()]
+            self._worst = [(rate, -sequence, txid)
+                           for txid, (rate, sequence, _, _)
+                           in self._entries.items()]
+            heapq.heapify(self._best)
+            heapq.heapify(self._worst)
@@ -1,12 +1,12 @@
 import binascii
-import json
 import logging
-import threading
 import time
 
 from block import Block
+from mempool import Mempool
 from node import Network, Node
-from transaction import Transaction
+from proof_of_work import ProofOfWorkEngine
+from validation import network_difficulty
 
 
 class Miner(Node):
@@ -16,40 +16,61 @@ class Miner(Node):
     announced it will start mining from that block
     """
 
-    def __init__(self, wallet, quantcoin, ip="0.0.0.0", port=65345):
-        Node.__init__(self, quantcoin=quantcoin, ip=ip, port=port)
+    DEFAULT_MAX_BLOCK_BYTES = 1024 * 1024
+
+    def __init__(self, wallet, quantcoin, ip="0.0.0.0", port=65345,
+                 mempool_max_count=Mempool.DEFAULT_MAX_COUNT,
+                 mempool_max_bytes=Mempool.DEFAULT_MAX_BYTES,
+                 max_block_bytes=DEFAULT_MAX_BLOCK_BYTES, workers=1,
+                 validation_workers=1):
+        """
+        Instantiates a miner.
+
+        :param wallet: the address of the wallet that authors the blocks.
+        :param mempool_max_count: the maximum number of transactions waiting
+                to be mined.
+        :param mempool_max_bytes: the maximum size of the transactions waiting
+                to be mined.
+        :param max_block_bytes: the maximum size of the transactions included
+                in a block.
+        :param workers: the number of processes searching nonces. With more
+                than one the search is done by a ProofOfWorkEngine.
+        :param validation_workers: the number of processes verifying the
+                signatures of the transactions of a new block.
+        """
+        Node.__init__(self, quantcoin=quantcoin, ip=ip, port=port,
+                      validation_workers=validation_workers)
 
         self._wallet = wallet
-        self._transaction_queue = []
-        self._transaction_queue_lock = threading.Lock()
+        self._mempool = Mempool(mempool_max_count, mempool_max_bytes)
+        self._max_block_bytes = max_block_bytes
+        self._engine = ProofOfWorkEngine(workers) if workers > 1 else None
 
-        known_blocks = quantcoin.blocks()
-        self._last_block = known_blocks[-1].digest() if len(known_blocks) > 0 else 'genesis_block'
-        self._last_block_index = number_of_blocks = len(known_blocks)
+        last_block = quantcoin.last_block()
+        self._last_block = last_block.digest() if last_block is not None else binascii.b2a_base64(Block.GENESIS)
+        self._last_block_index = number_of_blocks = quantcoin.height()
         self._mining = False
-        self._network_difficulty = int(52 - (50 / 1 + number_of_blocks // 100000))
+        self._network_difficulty = network_difficulty(number_of_blocks)
 
     def new_block(self, data, *args, **kwargs):
         """
-        Removes transactions already mined from the queue and changes previous block.
+        Removes transactions already mined from the queue and changes previous
+        block, once the block is accepted.
 
         :param data: The new block as a dictionary
         """
-        Node.new_block(self, data, args, kwargs)
-
-        block = Block.from_json(data['block'])
+        block = self._accept_block(data)
+        if block is None:
+            return
 
-        self._transaction_queue_lock.acquire()
-        # Remove transactions already processed from the queue
+        # Remove transactions already processed from the mempool
         for transaction in block.transactions():
-            if transaction in self._transaction_queue:
-                self._transaction_queue.remove(transaction)
-        self._transaction_queue_lock.release()
+            self._mempool.remove(transaction.txid())
 
-        known_blocks = self._quantcoin.blocks()
-        self._last_block = known_blocks[-1].digest() if len(known_blocks) > 0 else 'genesis_block'
-        self._last_block_index = number_of_blocks = len(known_blocks)
-        self._network_difficulty = int(52 - (50 / 1 + number_of_blocks // 100000))
+        last_block = self._quantcoin.last_block()
+        self._last_block = last_block.digest() if last_block is not None else binascii.b2a_base64(Block.GENESIS)
+        self._last_block_index = number_of_blocks = self._quantcoin.height()
+        self._network_difficulty = network_difficulty(number_of_blocks)
 
     def send(self, data, *args, **kwargs):
         """
@@ -57,18 +78,14 @@ class Miner(Node):
 
         :param data: The message data for transaction
         """
-        Node.send(self, data, args, kwargs)
-        transaction_data = json.loads(data['transaction'])
-        transaction = Transaction(from_wallet=transaction_data['body']['from'],
-                                  to_wallets=transaction_data['body']['to'],
-                                  signature=transaction_data['signature'],
-                                  public_key=transaction_data['public_key'])
+        transaction = self._receive_transaction(data)
 
-        if transaction.verify():
-            logging.debug("Transaction being included in the mining queue. {}".format(data['transaction']))
-            self._transaction_queue_lock.acquire()
-            self._transaction_queue.append(transaction)
-            self._transaction_queue_lock.release()
+        if transaction is not None and \
+                transaction.txid() not in self._mempool and \
+                not self._quantcoin.ledger().is_spent(transaction) and \
+                transaction.verify():
+            logging.debug("Transaction being included in the mempool. {}".format(data['transaction']))
+            self._mempool.add(transaction)
 
     def mine(self, min_transaction_count=0, min_commission=-1):
         """
@@ -81,40 +98,45 @@ class Miner(Node):
         print("Starting miner")
         network = Network(self._quantcoin)
         while self._mining:
-            known_blocks = self._quantcoin.blocks()
-            number_of_blocks = len(known_blocks)
-            self._last_block = known_blocks[-1].digest() if number_of_blocks > 0 else 'genesis_block'
-            self._transaction_queue_lock.acquire()
-            if min_transaction_count > len(self._transaction_queue):
-                logging.info("Not enough transactions: {} transactions.".format(len(self._transaction_queue)))
-                self._transaction_queue_lock.release()
+            last_block = self._quantcoin.last_block()
+            self._last_block = last_block.digest() if last_block is not None else binascii.b2a_base64(Block.GENESIS)
+            if min_transaction_count > len(self._mempool):
+                logging.info("Not enough transactions: {} transactions.".format(len(self._mempool)))
                 time.sleep(5)
                 continue
             if min_commission > 0:
-                commission = sum(t.commission() for t in self._transaction_queue)
+                commission = self._mempool.commission()
                 if commission < min_commission:
                     logging.info("Target commission not reached: {} commission reached.".format(commission))
-                    self._transaction_queue_lock.release()
                     time.sleep(5)
                     continue
 
             block = Block(author=self._wallet,
-                          transactions=self._transaction_queue,
+                          transactions=self._select_transactions(),
                           previous_block=binascii.a2b_base64(self._last_block))
 
-            self._transaction_queue = []
-            self._transaction_queue_lock.release()
-
             logging.info("Starting to mine block.")
             block_index = self.last_block_index()
-            start_nonce = 0
-            while (block_index == self.last_block_index() and self.mining() and
-                    not block.proof_of_work(self._network_difficulty,
-                                            start_nonce, start_nonce + 100)):
-                start_nonce += 101
+            if self._engine is not None:
+                nonce = self._engine.search(
+                    block, self._network_difficulty,
+                    lambda: block_index != self.last_block_index() or
+                    not self.mining())
+                if nonce is not None:
+                    block.proof_of_work(self._network_difficulty, nonce, nonce)
+            else:
+                start_nonce = 0
+                while (block_index == self.last_block_index() and self.mining() and
+                        not block.proof_of_work(self._network_difficulty,
+                                                start_nonce, start_nonce + 100)):
+                    start_nonce += 101
 
             if block.nonce() is not None:
-                network.new_block(block)
+                # The block may come back from the network after the next one
+                # is started, its transactions must not be mined again
+                for transaction in block.transactions():
+                    self._mempool.remove(transaction.txid())
+                network.new_block(block, self._relayed)
                 logging.info("Block found! Block digest: {}; Transactions: {}"
                              .format(block.digest(), len(block.transactions())))
                 print("Block found! Block digest: {}; Transactions: {}; difficulty: {}"
@@ -122,6 +144,44 @@ class Miner(Node):
 
         print("Terminating miner...")
 
+    def _known_transaction(self, txid):
+        """
+        Obtains a transaction from the mempool, or among the ones relayed by
+        this node.
+        """
+        transaction = self._mempool.get(txid)
+        if transaction is None:
+            transaction = Node._known_transaction(self, txid)
+        return transaction
+
+    def _select_transactions(self):
+        """
+        Chooses the transactions of the next block from the mempool. The
+        transactions already included in the blockchain, as by blocks
+        received while syncing, and the other encodings of a transaction
+        chosen are dropped from the mempool instead.
+        """
+        ledger = self._quantcoin.ledger()
+        transactions = []
+        spend_ids = set()
+        for transaction in self._mempool.select(self._max_block_bytes):
+            if ledger.is_spent(transaction) or \
+                    transaction.spend_id() in spend_ids:
+                self._mempool.remove(transaction.txid())
+            else:
+                spend_ids.add(transaction.spend_id())
+                transactions.append(transaction)
+        return transactions
+
+    def hash_rate(self):
+        """
+        Returns the hash rate of the mining workers, None when mining in a
+        single process
+        """
+        if self._engine is None:
+            return None
+        return self._engine.hash_rate()
+
     def last_block_index(self):
         """
         Returns the last known block index
@@ -1,16 +1,20 @@
 import binascii
-import exceptions
-import hashlib
+import collections
 import json
 import logging
 import random
-import socket
-import struct
-import thread
-
-from ecdsa import SECP256k1, VerifyingKey
+import threading
+import time
 
+import framing
 from block import Block
+from connections import connection_pool
+from dispatcher import request_dispatcher
+from inventory import Inventory
+from server import EventLoopServer
+from transaction import Transaction
+from validation import SignatureVerifier, check_transactions, \
+    network_difficulty
 
 
 class Node:
@@ -20,9 +24,48 @@ class Node:
     a synced public store.
     """
 
-    def __init__(self, quantcoin, ip="0.0.0.0", port=65345):
+    # The validation stages of a new block, cheapest first
+    STAGES = ("shape", "previous", "proof_of_work", "merkle_root",
+              "transactions", "signatures")
+    MAX_BLOCK_TRANSACTIONS = 10000
+    REJECTED_SIZE = 10000
+    PARTIAL_BLOCKS = 100
+
+    # The size of the frames streaming blocks and the number of blocks read
+    # from the block storage at once to fill them
+    FRAME_SIZE = 1024 * 1024
+    BLOCKS_PER_READ = 100
+
+    # The commands answered from memory, run by the event loop itself
+    INLINE_COMMANDS = ("get_nodes", "register", "get_tip")
+
+    # The largest block locator accepted
+    MAX_LOCATOR = 64
+
+    def __init__(self, quantcoin, ip="0.0.0.0", port=65345,
+                 validation_workers=1,
+                 max_connections=EventLoopServer.DEFAULT_MAX_CONNECTIONS,
+                 read_timeout=EventLoopServer.DEFAULT_READ_TIMEOUT,
+                 handler_workers=EventLoopServer.DEFAULT_WORKERS,
+                 idle_timeout=EventLoopServer.DEFAULT_IDLE_TIMEOUT,
+                 compression_level=framing.DEFAULT_COMPRESSION_LEVEL,
+                 compression_threshold=framing.DEFAULT_COMPRESSION_THRESHOLD):
         """
         Instantiates a node to handle network requests.
+
+        :param validation_workers: the number of processes verifying the
+                signatures of the transactions of a new block.
+        :param max_connections: the maximum number of connections open at
+                once, the others wait to be accepted.
+        :param read_timeout: the time a peer has to send a command, in seconds.
+        :param handler_workers: the number of threads running the commands
+                not answered from memory, like the validation of blocks.
+        :param idle_timeout: the time a peer connection is kept open without
+                commands, in seconds.
+        :param compression_level: the zlib level of the frames compressed
+                for the peers negotiating it, None to never compress.
+        :param compression_threshold: the size of the smallest frame
+                compressed, in bytes.
         """
         logging.debug("Creating Node: ip={}, port={}".format(ip, port))
         if quantcoin is None:
@@ -34,11 +77,31 @@ class Node:
         self._cmds = {
             "get_nodes": self.get_nodes,
             "get_blocks": self.get_blocks,
+            "get_tip": self.get_tip,
             "register": self.register,
             "new_block": self.new_block,
-            "send": self.send
+            "send": self.send,
+            "inv": self.inv,
+            "compact_block": self.compact_block,
+            "block_transactions": self.block_transactions
         }
         self._running = False
+        self._server = None
+        self._max_connections = max_connections
+        self._read_timeout = read_timeout
+        self._handler_workers = handler_workers
+        self._idle_timeout = idle_timeout
+        self._compression_level = compression_level
+        self._compression_threshold = compression_threshold
+        self._verifier = SignatureVerifier(validation_workers)
+        self._validation_latency = None
+        self._rejected = collections.OrderedDict()
+        self._validating = set()
+        self._rejections = dict((stage, 0) for stage in self.STAGES)
+        self._dropped = 0
+        self._validation_lock = threading.Lock()
+        self._inventory = Inventory()
+        self._partial_blocks = collections.OrderedDict()
 
         self._network = Network(quantcoin)
 
@@ -50,20 +113,76 @@ class Node:
         nodes = self._quantcoin.all_nodes()
         return json.dumps(nodes)
 
-    def get_blocks(self, data, *args, **kwargs):
+    def get_blocks(self, data, connection=None, *args, **kwargs):
         """
         Responds to the command with all blocks, or if a range was requested,
-        with that range.
+        with that range. The blocks are streamed as a sequence of frames, each
+        one a JSON list of blocks, ended by an empty frame. The records are
+        copied straight from the block storage, without decoding the blocks.
         """
         logging.debug("Blocks requested (ranged: {})".format('range' in data))
-        blocks = []
-        if 'range' in data:
-            blocks = self._quantcoin.block(data['range'][0], data['range'][1])
-        else:
-            blocks = self._quantcoin.blocks()
-
-        blocks = [block.json() for block in blocks]
-        return json.dumps(blocks)
+        start, end = data['range'] if 'range' in data else (0, None)
+        if connection is None:
+            records = self._quantcoin.raw_blocks(start, end)
+            return '[' + ','.join(str(record) for record in records) + ']'
+
+        framing.send_frames(connection, self._block_frames(start, end))
+
+    def get_tip(self, data, *args, **kwargs):
+        """
+        Responds to the command with the height and the digest of the last
+        block of this node. The peer sends along a block locator, the digests
+        of some of its blocks from its tip backwards, and the response tells
+        how many blocks the chains have in common: the blocks up to the first
+        digest of the locator known by this node. If the peer informs the
+        digest of its assume valid block the response also tells the height
+        of that block, when this node has it.
+        """
+        locator = data.get('locator', [])
+        if not isinstance(locator, list):
+            locator = []
+        common = 0
+        for digest in locator[:self.MAX_LOCATOR]:
+            height = self._quantcoin.height_of(digest) \
+                if isinstance(digest, basestring) else None
+            if height is not None:
+                common = height + 1
+                break
+
+        assume_valid = data.get('assume_valid')
+        assume_valid_height = self._quantcoin.height_of(assume_valid) \
+            if isinstance(assume_valid, basestring) else None
+
+        height = self._quantcoin.height()
+        logging.debug("Tip requested(height={}, common={})".
+                      format(height, common))
+        return json.dumps({
+            'height': height,
+            'digest': self._quantcoin.digest_at(height - 1),
+            'common': common,
+            'assume_valid_height': assume_valid_height
+        })
+
+    def _block_frames(self, start, end):
+        """
+        Splits a range of blocks in frames of about FRAME_SIZE bytes.
+
+        :returns a generator of the frames payloads.
+        """
+        start, end, _ = slice(start, end).indices(self._quantcoin.height())
+        records = []
+        size = 0
+        for read_start in xrange(start, end, self.BLOCKS_PER_READ):
+            for record in self._quantcoin.raw_blocks(
+                    read_start, min(read_start + self.BLOCKS_PER_READ, end)):
+                if records and size + len(record) > self.FRAME_SIZE:
+                    yield '[' + ','.join(records) + ']'
+                    records = []
+                    size = 0
+                records.append(str(record))
+                size += len(record) + 1
+        if records:
+            yield '[' + ','.join(records) + ']'
 
     def register(self, data, *args, **kwargs):
         """
@@ -76,100 +195,326 @@ class Node:
         """
         Verifies and store the new block announced in the network if valid.
         """
+        self._accept_block(data)
+
+    def _accept_block(self, data):
+        """
+        Verifies a new block and stores it if valid.
+
+        The block goes through the validation stages from the cheapest to the
+        most expensive and is dropped by the first one it fails. Blocks
+        recently rejected and blocks already being validated are dropped
+        before being parsed.
+
+        :returns the block if it was accepted, None otherwise.
+        """
+        logging.debug("New block announced(block: {})".format(data))
+        started = time.time()
+        announced = data.get('block')
+        digest = announced.get('digest') \
+            if isinstance(announced, dict) else None
+        if not isinstance(digest, basestring):
+            self._reject(None, "shape")
+            return
+
+        with self._validation_lock:
+            if digest in self._rejected or digest in self._validating or \
+                    self._inventory.seen(digest):
+                self._dropped += 1
+                logging.debug("Block dropped, rejected or being validated")
+                return
+            self._validating.add(digest)
+
+        try:
+            if self._quantcoin.has_block(digest):
+                logging.debug("Block already known")
+                return
+
+            # Until the header is checked the digest is not bound to the rest
+            # of the data, a failure before that is not remembered or a
+            # forged announcement could shadow the real block. A block not
+            # linked to the tip may also become valid after a sync.
+            block = self._parse_block(announced)
+            if block is None:
+                self._reject(None, "shape")
+                return
+
+            with self._quantcoin.lock():
+                last_block = self._quantcoin.last_block()
+                height = self._quantcoin.height()
+            expected = last_block.digest() if last_block is not None \
+                else binascii.b2a_base64(Block.GENESIS)
+            if block.previous() != expected:
+                self._reject(None, "previous")
+                return
+
+            difficulty = network_difficulty(height)
+            if block.raw_digest()[:difficulty] != '\x00' * difficulty:
+                self._reject(digest, "proof_of_work")
+                return
+
+            # Hashing the header checks the Merkle root of the transactions
+            if not block.valid(difficulty):
+                self._reject(None, "merkle_root")
+                return
+
+            try:
+                with self._quantcoin.lock():
+                    # The ledger must be the one of the block linked to
+                    if self._quantcoin.height() != height:
+                        self._reject(None, "previous")
+                        return
+                    signed_transactions = check_transactions(
+                        block, height, self._quantcoin.ledger())
+            except AssertionError:
+                self._reject(digest, "transactions")
+                return
+
+            # Transactions must be created by the owners of the addresses
+            # and their integrity must be assured
+            if not self._verifier.verify(signed_transactions):
+                self._reject(digest, "signatures")
+                return
+
+            self._validation_latency = time.time() - started
+            logging.debug("Block accepted(validation: {:.3f}s, "
+                          "transactions: {})".
+                          format(self._validation_latency,
+                                 len(block.transactions())))
+            # Another block may have been stored on the same previous block
+            # while the signatures were verified
+            if not self._quantcoin.store_block(block, height):
+                logging.debug("Block not stored, the blockchain changed")
+                return
+            if self._inventory.mark_seen(digest):
+                self._network.new_block(block, self._relayed)
+            return block
+        finally:
+            with self._validation_lock:
+                self._validating.discard(digest)
+
+    def _parse_block(self, data):
+        """
+        Checks the shape of an announced block and parses it.
+
+        :returns the block, None if the data is not a well formed block.
+        """
+        transactions = data.get('transactions', [])
+        if not isinstance(transactions, list) or \
+                len(transactions) > self.MAX_BLOCK_TRANSACTIONS or \
+                not isinstance(data.get('author'), basestring) or \
+                not isinstance(data.get('previous'), basestring) or \
+                not isinstance(data.get('nonce'), (int, long)):
+            return None
+
         try:
-            logging.debug("New block announced(block: {})".format(data))
-            block = Block.from_json(data['block'])
-            known_blocks = self._quantcoin.blocks()
-            number_of_blocks = len(known_blocks)
-            network_difficulty = int(52 - (50 / 1 + number_of_blocks // 100000))
-            assert block.previous() == known_blocks[-1].digest() if number_of_blocks > 0 else binascii.b2a_base64(
-                'genesis_block')
-            assert block.valid(network_difficulty)
-
-            has_coin_creation_transaction = False
-            for transaction in block.transactions():
-                # If the transaction is the creation transaction we do not validate
-                if transaction.from_wallet() is not None:
-                    assert transaction.amount_spent() <= \
-                           self._quantcoin.amount_owned(transaction.from_wallet())
-
-                    # An address cannot send money to itself
-                    for to_address, _ in transaction.to_wallets():
-                        assert to_address != transaction.from_wallet()
-
-                    transaction_public_key = transaction.public_key()
-
-                    public_key = VerifyingKey.from_string(
-                        binascii.a2b_base64(transaction_public_key),
-                        curve=SECP256k1)
-
-                    # A transaction must be created by the owner of the address
-                    address = 'QC' + hashlib.sha1(public_key.to_string()).hexdigest()
-                    assert address == transaction.from_wallet()
-
-                    # The transaction integrity must be assured
-                    assert public_key.verify(transaction.signature(),
-                                             transaction.prepare_for_signature(),
-                                             hashfunc=hashlib.sha256)
-                else:
-                    assert not has_coin_creation_transaction
-                    assert transaction.amount_spent() <= 100 / (1 + (number_of_blocks // 100000))
-                    # Only one coin creation transaction allowed
-                    has_coin_creation_transaction = True
-
-            logging.debug("Block accepted")
-            self._quantcoin.store_block(block)
-            self._network.forward(data)
-        except AssertionError:
-            logging.debug("Block rejected: {}".format(data['block']))
+            block = Block.from_json(data)
+        except (KeyError, TypeError, AttributeError, binascii.Error):
+            return None
+
+        if block.raw_digest() is None or len(block.raw_digest()) != 32:
+            return None
+        return block
+
+    def _reject(self, digest, stage):
+        """
+        Counts a block rejected by a validation stage and remembers its
+        digest, if informed, so the block is dropped if announced again.
+        """
+        logging.debug("Block rejected(stage: {}, digest: {})".
+                      format(stage, digest))
+        with self._validation_lock:
+            self._rejections[stage] += 1
+            if digest is not None:
+                self._rejected[digest] = True
+                while len(self._rejected) > self.REJECTED_SIZE:
+                    self._rejected.popitem(last=False)
+
+    def rejections(self):
+        """
+        The number of blocks rejected by each validation stage.
+        """
+        with self._validation_lock:
+            return dict(self._rejections)
+
+    def dropped(self):
+        """
+        The number of announced blocks dropped without validation for having
+        been rejected recently or for being already validated.
+        """
+        return self._dropped
+
+    def validation_latency(self):
+        """
+        The time spent validating the last accepted block, in seconds.
+        """
+        return self._validation_latency
+
+    @staticmethod
+    def traffic():
+        """
+        The bytes exchanged with each peer over compressed connections,
+        before compression and on the wire.
+
+        :returns a dict of dicts with the sent_raw, sent_compressed,
+                 received_raw and received_compressed bytes, by peer address.
+        """
+        return framing.traffic.peers()
 
     def send(self, data, *args, **kwargs):
         """
-        Ignores the transaction announcement in the network.
+        Relays a transaction to the network.
+        """
+        self._receive_transaction(data)
+
+    def _receive_transaction(self, data):
+        """
+        Announces a transaction to the peers the first time it is received.
+
+        :returns the transaction, None if it was already seen.
         """
         logging.debug("Transaction received({})".format(data['transaction']))
-        self._network.forward(data)
+        transaction = Transaction.from_json(data['transaction'])
+        if not self._inventory.mark_seen(transaction.txid()):
+            return None
+        self._inventory.add_transaction(transaction)
+        self._network.send(transaction)
+        return transaction
+
+    def _relayed(self, transaction):
+        """
+        True if the transaction was relayed through the network, the peers
+        are then expected to have it.
+        """
+        return self._inventory.seen(transaction.txid())
+
+    def _known_transaction(self, txid):
+        """
+        Obtains a transaction received by this node and not yet mined.
+
+        :returns the transaction, None if it is not known.
+        """
+        return self._inventory.transaction(txid)
+
+    def compact_block(self, data, *args, **kwargs):
+        """
+        Rebuilds a block announced in compact form from the transactions
+        already received by this node and the ones sent along. A complete
+        block is verified as a new block, otherwise it is kept until the peer
+        sends the missing transactions.
+
+        :returns the txids of the transactions this node lacks.
+        """
+        compact = data['block']
+        digest = compact['digest']
+        txids = compact['txids']
+        if not isinstance(txids, list) or \
+                len(txids) > self.MAX_BLOCK_TRANSACTIONS or \
+                digest in self._rejected or self._inventory.seen(digest) or \
+                self._quantcoin.has_block(digest):
+            return json.dumps({'missing': []})
+
+        prefilled = {}
+        for transaction_data in compact.get('transactions', []):
+            transaction = Transaction.from_json(transaction_data)
+            prefilled[transaction.txid()] = transaction
+
+        transactions = {}
+        missing = []
+        for txid in txids:
+            transaction = prefilled.get(txid) or self._known_transaction(txid)
+            if transaction is None:
+                missing.append(txid)
+            else:
+                transactions[txid] = transaction
+
+        logging.debug("Compact block received(digest: {}, transactions: {}, "
+                      "missing: {})".format(digest, len(txids), len(missing)))
+        if missing:
+            with self._validation_lock:
+                self._partial_blocks[digest] = (compact, transactions)
+                while len(self._partial_blocks) > self.PARTIAL_BLOCKS:
+                    self._partial_blocks.popitem(last=False)
+        else:
+            self._complete_block(compact, transactions)
+        return json.dumps({'missing': missing})
 
-    def handle(self, connection, address):
+    def block_transactions(self, data, *args, **kwargs):
         """
-        Handles a command received from another node calling the proper
-        function.
+        Completes a compact block with the transactions this node lacked.
         """
-        logging.debug("handling connection(address={})".format(address))
-        data_len = struct.unpack("I", connection.recv(4))[0]
-        data = connection.recv(data_len)
-        if data is not None:
-            try:
-                data = json.loads(data)
-                response = self._cmds[data['cmd']](data, connection)
-                if response is not None:
-                    connection.send(struct.pack("I", len(response)))
-                    connection.send(response)
-            except exceptions.NameError as e:
-                logging.debug("An exception occurred on connection handle. {}".
-                              format(e))
+        with self._validation_lock:
+            partial = self._partial_blocks.pop(data['digest'], None)
+        if partial is None:
+            return
+
+        compact, transactions = partial
+        for transaction_data in data['transactions']:
+            transaction = Transaction.from_json(transaction_data)
+            transactions[transaction.txid()] = transaction
+
+        if all(txid in transactions for txid in compact['txids']):
+            self._complete_block(compact, transactions)
+        else:
+            logging.debug("Compact block incomplete(digest: {})".
+                          format(data['digest']))
+
+    def _complete_block(self, compact, transactions):
+        """
+        Verifies and stores a block rebuilt from its compact form.
+        """
+        block = {
+            'author': compact['author'],
+            'nonce': compact['nonce'],
+            'digest': compact['digest'],
+            'previous': compact['previous'],
+            'transactions': [transactions[txid].json()
+                             for txid in compact['txids']]
+        }
+        self.new_block({'block': block})
+
+    def inv(self, data, *args, **kwargs):
+        """
+        Responds to the announcement of blocks and transactions with the ones
+        this node lacks, the peer then sends their bodies. A message already
+        asked to another peer is not asked again until that request times out.
+        """
+        ledger = self._quantcoin.ledger()
+        blocks = [digest for digest in data.get('blocks', [])
+                  if isinstance(digest, basestring) and
+                  digest not in self._rejected and
+                  not self._quantcoin.has_block(digest) and
+                  self._inventory.want(digest)]
+        transactions = [txid for txid in data.get('transactions', [])
+                        if isinstance(txid, basestring) and
+                        ledger.spent_height(txid) is None and
+                        self._inventory.want(txid)]
+        return json.dumps({'blocks': blocks, 'transactions': transactions})
 
     def run(self):
         """
-        Awaits and handles commands indefinitely.
+        Awaits and handles commands until stopped.
         """
         logging.debug("Node running(ip={}, port={})".
                       format(self._ip, self._port))
-        s = socket.socket()
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((self._ip, self._port))
-        s.listen(5)
+        self._server = EventLoopServer(self._ip, self._port, self._cmds,
+                                       self.INLINE_COMMANDS,
+                                       self._max_connections,
+                                       self._read_timeout,
+                                       self._handler_workers,
+                                       self._idle_timeout,
+                                       self._compression_level,
+                                       self._compression_threshold)
         self._running = True
-        while self._running:
-            connection, address = s.accept()
-            thread.start_new_thread(self.handle, (connection, address))
-        s.close()
+        self._server.run()
 
     def stop(self):
         """
         Stops the node
         """
         self._running = False
+        if self._server is not None:
+            self._server.stop()
 
 
 class Network:
@@ -178,13 +523,27 @@ class Network:
     network.
     """
 
-    def __init__(self, quantcoin):
+    DEFAULT_FANOUT = 8
+
+    def __init__(self, quantcoin, pool=None, dispatcher=None,
+                 fanout=DEFAULT_FANOUT):
         """
         Instantiates a Network. A QuantCoin instance is mandatory.
+
+        :param pool: the ConnectionPool holding the connections to the peers,
+                the one shared by the process if not informed. It sets the
+                connect and read timeouts of every peer.
+        :param dispatcher: the Dispatcher sending the commands, the one shared
+                by the process if not informed.
+        :param fanout: the number of peers a command is sent to.
         """
         if quantcoin is None:
             raise Exception("A Network must have a QuanCoin instance to work.")
         self._quantcoin = quantcoin
+        self._pool = pool if pool is not None else connection_pool
+        self._dispatcher = dispatcher if dispatcher is not None \
+            else request_dispatcher
+        self._fanout = fanout
 
     def forward(self, cmd):
         """
@@ -192,39 +551,70 @@ class Network:
         """
         self._send_cmd(cmd)
 
-    def _send_cmd(self, cmd, receive_function=None):
+    def _send_cmd(self, cmd, receive_function=None, streamed=False):
         """
-        Sends the command to all peers known in the network. If the peer
-        respond, the data is passed trough the callback receive_function if it
-        was provided.
+        Sends the command to a sample of the peers known in the network. The
+        command is sent to each peer by the dispatcher, concurrently, and this
+        method does not wait for it. If the peer respond, the data is passed
+        trough the callback receive_function if it was provided.
 
         :param cmd: the command to be sent to the network.
         :param receive_function: the callback function if data is produced by the
-                it will be called from different threads.
                 execution of the command. This function must be thread safe as
+                it will be called from different threads.
+        :param streamed: True if the response is a stream of frames, the
+                callback is then called once per frame.
+
+        :returns the number of peers the command was scheduled to, the ones
+                 still handling the same command excluded.
         """
         cmd_string = json.dumps(cmd)
         nodes = self._quantcoin.all_nodes()
-        if nodes is not None:
-            nodes = random.sample(nodes, 100)
-            for node in nodes:
-                s = socket.socket()
-                try:
-                    s.connect(node)
-                except Exception:
-                    s.close()
-                    continue
-
-                s.send(struct.pack("I", len(cmd_string)))
-                s.send(cmd_string)
-                if receive_function is not None:
-                    data_len = struct.unpack("I", s.recv(4))[0]
-                    data = s.recv(data_len)
-                    data = json.loads(data)
-                    receive_function(data, s)
-                s.close()
-        else:
+        if not nodes:
             logging.warn("No nodes registered. Cmd: {}".format(cmd))
+            return 0
+
+        self._pool.close_idle()
+        scheduled = 0
+        for node in random.sample(nodes, min(self._fanout, len(nodes))):
+            node = tuple(node)
+            key = (node, cmd_string, receive_function, streamed)
+            if self._dispatcher.submit(key, self._send_to, node, cmd_string,
+                                       receive_function, streamed):
+                scheduled += 1
+        return scheduled
+
+    def _send_to(self, node, cmd_string, receive_function, streamed):
+        """
+        Sends a command to a peer over a pooled connection. A reused
+        connection may have been closed by the peer meanwhile, the command is
+        then sent again over a new one, unless part of the response was
+        already received.
+        """
+        for _ in range(2):
+            acquired = self._pool.acquire(node)
+            if acquired is None:
+                return
+            connection, reused = acquired
+            received = False
+            try:
+                framing.send_frame(connection, cmd_string)
+                if receive_function is not None:
+                    frames = framing.recv_frames(connection) if streamed \
+                        else [framing.recv_frame(connection)]
+                    for frame in frames:
+                        if frame is None:
+                            raise framing.FramingError("Connection closed")
+                        received = True
+                        receive_function(json.loads(frame), connection)
+                self._pool.release(node, connection)
+                return
+            except Exception as e:
+                self._pool.release(node, connection, reusable=False)
+                logging.debug("Command failed(node={}). {}".format(node, e))
+                if not reused or received:
+                    self._pool.failed(node)
+                    return
 
     def register(self, ip, port):
         """
@@ -241,22 +631,49 @@ class Network:
             'port': port
         }
 
-        thread.start_new_thread(self._send_cmd, (cmd,))
+        self._send_cmd(cmd)
 
-    def new_block(self, block):
+    def new_block(self, block, relayed=None):
         """
-        Sends a new_block command to the network.
+        Announces a new block to the network. The peers that ask for it
+        receive it in compact form: the header, the txids and the transactions
+        they may lack. A peer answers with the txids it could not find and
+        their transactions are then sent to it.
 
         :param block: The block to be added to the blockchain.
+        :param relayed: a function telling if a transaction was relayed
+                through the network, those are not sent along. Every
+                transaction is sent along if not informed.
         """
-        logging.debug("Sending new block")
-        block_json = block.json()
+        logging.debug("Announcing new block({})".format(block.digest()))
         cmd = {
-            'cmd': 'new_block',
-            'block': block_json
+            'cmd': 'compact_block',
+            'block': block.compact_json(
+                lambda transaction: relayed is None or
+                not relayed(transaction))
         }
-
-        thread.start_new_thread(self._send_cmd, (cmd,))
+        body = json.dumps(cmd)
+
+        def send_block(connection):
+            framing.send_frame(connection, body)
+            response = framing.recv_frame(connection)
+            if response is None:
+                raise framing.FramingError("Connection closed")
+            missing = json.loads(response).get('missing', [])
+            if missing:
+                transactions = dict((transaction.txid(), transaction)
+                                    for transaction in block.transactions())
+                cmd = {
+                    'cmd': 'block_transactions',
+                    'digest': block.digest(),
+                    'transactions': [transactions[txid].json()
+                                     for txid in missing
+                                     if txid in transactions]
+                }
+                framing.send_frame(connection, json.dumps(cmd))
+
+        self._announce({'blocks': [block.digest()]},
+                       {block.digest(): send_block})
 
     def get_nodes(self, nodes_data_handler):
         """
@@ -270,12 +687,13 @@ class Network:
             'cmd': 'get_nodes'
         }
 
-        thread.start_new_thread(self._send_cmd, (cmd, nodes_data_handler))
+        self._send_cmd(cmd, nodes_data_handler)
 
     def get_blocks(self, blocks_data_handler):
         """
         Asks for the full blockchain. The blockchain will be received trough
-        the blocks_data_handler callback.
+        the blocks_data_handler callback, called with each list of blocks
+        streamed by a peer.
 
         :param blocks_data_handler: The callback used to receive the full
                                     blockchain.
@@ -285,12 +703,13 @@ class Network:
             'cmd': 'get_blocks'
         }
 
-        thread.start_new_thread(self._send_cmd, (cmd, blocks_data_handler))
+        self._send_cmd(cmd, blocks_data_handler, True)
 
     def get_range_blocks(self, start, end, blocks_data_handler):
         """
         Asks for a slice of the blockchain. The slice will be received trough
-        the blocks_data_handler callback.
+        the blocks_data_handler callback, called with each list of blocks
+        streamed by a peer.
 
         :param blocks_data_handler: The callback used to receive the slice of the
                                     blockchain.
@@ -302,16 +721,87 @@ class Network:
             'range': [start, end]
         }
 
-        thread.start_new_thread(self._send_cmd, (cmd, blocks_data_handler))
+        self._send_cmd(cmd, blocks_data_handler, True)
+
+    def get_tip(self, locator, tip_handler, assume_valid=None):
+        """
+        Asks for the last block of the peers. The tip of each peer will be
+        received through the tip_handler callback, with the connection the
+        tip was received on, which can be used to ask for the blocks lacking.
+
+        :param locator: the digests of some blocks of this node, from the tip
+                backwards, for the peers to tell how many blocks they have in
+                common with this node.
+        :param tip_handler: The callback used to receive the tips.
+        :param assume_valid: the digest, encoded in base64, of the assume
+                valid block, for the peers to tell its height.
+        """
+        logging.debug("Asking for tips(locator={})".format(len(locator)))
+        cmd = {
+            'cmd': 'get_tip',
+            'locator': locator
+        }
+        if assume_valid is not None:
+            cmd['assume_valid'] = assume_valid
+
+        self._send_cmd(cmd, tip_handler)
+
+    @staticmethod
+    def fetch_blocks(connection, start, end, blocks_data_handler):
+        """
+        Asks a peer for a slice of the blockchain over a connection to it,
+        waiting for the whole slice.
+
+        :param connection: a connection to the peer, not in use by another
+                command.
+        :param blocks_data_handler: The callback called with each list of
+                blocks streamed by the peer.
+        """
+        logging.debug("Fetching a range of blocks(start={}, end={})".
+                      format(start, end))
+        cmd = {
+            'cmd': 'get_blocks',
+            'range': [start, end]
+        }
+
+        framing.send_frame(connection, json.dumps(cmd))
+        for frame in framing.recv_frames(connection):
+            blocks_data_handler(json.loads(frame))
 
     def send(self, transaction):
         """
-        Announces to the network a transaction.
+        Announces to the network a transaction. The transaction is sent to the
+        peers that ask for it.
         """
-        logging.debug("Sending: {}".format(transaction.json()))
+        logging.debug("Announcing: {}".format(transaction.json()))
         cmd = {
             'cmd': 'send',
             'transaction': transaction.json()
         }
 
-        thread.start_new_thread(self._send_cmd, (cmd,))
+        body = json.dumps(cmd)
+        self._announce({'transactions': [transaction.txid()]},
+                       {transaction.txid():
+                        lambda connection: framing.send_frame(connection,
+                                                              body)})
+
+    def _announce(self, inventory, bodies):
+        """
+        Sends an inv command announcing the hashes of blocks and transactions.
+        Every peer answers with the hashes it lacks and their bodies are sent
+        to it right away, on the same connection.
+
+        :param inventory: the block digests and txids announced, by kind.
+        :param bodies: the functions sending each message on a connection,
+                by hash.
+        """
+        cmd = dict(inventory)
+        cmd['cmd'] = 'inv'
+
+        def send_bodies(wanted, connection):
+            for key in wanted.get('blocks', []) + \
+                    wanted.get('transactions', []):
+                if key in bodies:
+                    bodies[key](connection)
+
+        self._send_cmd(cmd, send_bodies)
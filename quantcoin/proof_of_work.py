@@ -0,0 +1,139 @@
+import logging
+import multiprocessing
+import Queue
+import threading
+import time
+
+from block import Block
+
+
+def _search(worker, workers, prefix, difficulty, batch_size, stop, results,
+            rate_interval):
+    """
+    Searches nonces in a worker process. The nonce space is cut in batches and
+    the batches are dealt to the workers in turns, so no two workers hash the
+    same nonce. The stop event is checked between batches.
+    """
+    batch = worker
+    hashes = 0
+    reported = time.time()
+    while not stop.is_set():
+        start = batch * batch_size
+        found = Block.search_nonce(prefix, difficulty,
+                                   start, start + batch_size - 1)
+        if found is not None:
+            results.put(('found', worker, found[0]))
+            return
+        hashes += batch_size
+        batch += workers
+
+        now = time.time()
+        if now - reported >= rate_interval:
+            results.put(('rate', worker, hashes / (now - reported)))
+            hashes = 0
+            reported = now
+
+
+class ProofOfWorkEngine(object):
+    """
+    A ProofOfWorkEngine searches the nonce of a block with a pool of
+    processes, one per core. The workers split the nonce space between them
+    and are stopped as soon as one of them finds a nonce or the search is
+    cancelled. Each worker reports its hash rate while searching.
+
+    The engine only finds the nonce, the block is sealed with it through
+    Block.proof_of_work, so the blocks produced are the same whatever the
+    number of workers.
+    """
+
+    DEFAULT_BATCH_SIZE = 20000
+    RATE_INTERVAL = 5.0
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, workers=None, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Instantiates a proof of work engine.
+
+        :param workers: the number of worker processes, the number of cores
+                if not informed.
+        :param batch_size: the number of nonces hashed by a worker between two
+                checks for cancellation.
+        """
+        self._workers = workers if workers is not None \
+            else multiprocessing.cpu_count()
+        self._batch_size = batch_size
+        self._rates = {}
+        self._rates_lock = threading.Lock()
+
+    def search(self, block, difficulty, cancelled):
+        """
+        Searches a nonce for a block.
+
+        :param block: the block being mined.
+        :param difficulty: the difficulty required by the blockchain.
+        :param cancelled: a function returning True when the search must stop,
+                polled while the workers run.
+
+        :returns the nonce found, None if the search was cancelled.
+        """
+        prefix = block.header_prefix()
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_search,
+                                             args=(worker, self._workers,
+                                                   prefix, difficulty,
+                                                   self._batch_size, stop,
+                                                   results,
+                                                   self.RATE_INTERVAL))
+                     for worker in range(self._workers)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        try:
+            while True:
+                try:
+                    message = results.get(timeout=self.POLL_INTERVAL)
+                except Queue.Empty:
+                    message = None
+
+                if message is not None and message[0] == 'found':
+                    return message[2]
+
+                if message is not None:
+                    _, worker, rate = message
+                    with self._rates_lock:
+                        self._rates[worker] = rate
+                    logging.debug("Worker hash rate(worker={}, "
+                                  "rate={:.0f}H/s)".format(worker, rate))
+
+                if cancelled():
+                    logging.debug("Proof of work search cancelled")
+                    return None
+        finally:
+            stop.set()
+            deadline = time.time() + 1.0
+            for process in processes:
+                process.join(max(0.0, deadline - time.time()))
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+    def hash_rates(self):
+        """
+        The last hash rate reported by each worker, in hashes per second.
+        """
+        with self._rates_lock:
+            return dict(self._rates)
+
+    def hash_rate(self):
+        """
+        The total hash rate of the workers, in hashes per second.
+        """
+        return sum(self.hash_rates().values())
+
+    def workers(self):
+        """
+        The number of worker processes.
+        """
+        return self._workers
@@ -4,6 +4,7 @@ import json
 import logging
 import random
 import string
+import threading
 
 import os
 import scrypt
@@ -13,6 +14,10 @@ from ecdsa import SECP256k1, SigningKey
 from ecdsa.util import randrange_from_seed__trytryagain
 
 from block import Block
+from blockstore import BlockStore
+from checkpoint import CheckpointStore
+from ledger import Ledger
+from validation import InvalidBlock
 
 
 class QuantCoin:
@@ -23,29 +28,81 @@ class QuantCoin:
     protected by a password only accessible by this node.
     """
 
+    DEFAULT_CHECKPOINT_INTERVAL = 1000
+
     def __init__(self):
         """
         Instantiates a QuantCoin storage.
         """
         self._blocks = []
+        self._heights = {}
+        self._store = None
+        self._ledger = None
+        self._checkpoints = None
+        self._checkpoint_interval = self.DEFAULT_CHECKPOINT_INTERVAL
+        self._lock = threading.RLock()
         self._peers = [("127.0.0.1", 65345)]
         self._public_wallets = []
         self._wallets = []
 
-    def load(self, database):
-        """
-        Loads the public store from a file. The file is a JSON that represents
-        the public storage of the network.
+    def load(self, database, fsync_interval=BlockStore.DEFAULT_FSYNC_INTERVAL,
+             checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL, verifier=None):
+        """
+        Loads the public store. The peers are kept in a JSON file and the
+        blockchain in an append-only block store next to it. Only the tail of
+        the block store is read, the blocks are loaded when first requested.
+        The ledger is restored from the newest valid checkpoint and only the
+        blocks stored after it are replayed.
+
+        A JSON file written by older versions still holds the blockchain. Those
+        blocks are imported once into an empty block store and dropped from
+        the JSON file on the next save.
 
         :param database: path to the public storage JSON file.
+        :param fsync_interval: number of blocks stored between two fsync calls.
+        :param checkpoint_interval: number of blocks stored between two
+                ledger checkpoints.
+        :param verifier: a ChainVerifier checking the imported and replayed
+                blocks. Imported blocks are kept up to the first invalid one,
+                an invalid block in the block store aborts the load with
+                InvalidBlock. Without a verifier the blocks are trusted.
         """
         logging.debug("Loading from database")
+        self._store = BlockStore(self.block_store_path(database),
+                                 fsync_interval=fsync_interval)
+        self._store.open()
+        self._checkpoints = CheckpointStore(database + '-checkpoints')
+        self._checkpoint_interval = checkpoint_interval
+        self._blocks = None
+        self._heights = None
+        self._ledger = None
+        loaded = self._load_public(database, verifier)
+        self._ledger = self._restore_ledger(verifier)
+        return loaded
+
+    def _load_public(self, database, verifier):
+        """
+        Loads the peers from the public storage JSON file, importing the blocks
+        of older versions of it.
+
+        :returns True if the file exists, False otherwise.
+        """
         if os.path.exists(database):
             with open(database, 'rb') as fp:
                 storage = json.load(fp)
-                blocks = storage['blocks']
-                self._blocks = [Block.from_json(block) for block in blocks]
                 self._peers = [tuple(peer) for peer in storage['peers']]
+                if 'blocks' in storage and self._store.height() == 0:
+                    logging.info("Importing {} blocks into the block store".
+                                 format(len(storage['blocks'])))
+                    blocks = [Block.from_json(block)
+                              for block in storage['blocks']]
+                    if verifier is None:
+                        for block in blocks:
+                            self._store.append(block)
+                    else:
+                        self._import_verified(blocks, verifier)
+                    self._store.sync()
+            return True
         else:
             logging.debug("Requested database does not exists(database={})".
                           format(database))
@@ -53,20 +110,100 @@ class QuantCoin:
 
     def save(self, database):
         """
-        Saves the public store to a file. The file will be saved in JSON
-        format.
+        Saves the public store. The peers are saved to a file in JSON format,
+        the blocks were already appended to the block store when stored, so
+        they are only synced to the disk.
 
         :param database: path to the file.
         """
         logging.debug("Saving to database")
+        if self._store is not None:
+            self._store.sync()
+            self.checkpoint()
         with open(database, 'wb') as fp:
-            json_blocks = [block.json() for block in self._blocks]
             storage = {
-                'blocks': json_blocks,
                 'peers': self._peers
             }
             json.dump(storage, fp)
 
+    def checkpoint(self):
+        """
+        Writes a checkpoint of the ledger at the current height.
+        """
+        with self._lock:
+            height = self.height()
+            if self._checkpoints is None or self._ledger is None or \
+                    height == 0:
+                return
+            self._checkpoints.write(height, self._store.digest(height - 1),
+                                    self._ledger.balances(),
+                                    self._ledger.spent(),
+                                    self._ledger.spent_ids())
+
+    def _import_verified(self, blocks, verifier):
+        """
+        Imports the blocks of an older public storage file up to the first
+        invalid one, and checkpoints the ledger built while verifying them so
+        they are not verified again when the ledger is restored.
+        """
+        ledger = Ledger()
+        try:
+            for block in verifier.verify(blocks, 0, Block.GENESIS, ledger):
+                self._store.append(block)
+                ledger.apply_block(block)
+        except InvalidBlock as e:
+            logging.warn("Import stopped: {}".format(e))
+
+        height = self._store.height()
+        if height > 0:
+            self._checkpoints.write(height, self._store.digest(height - 1),
+                                    ledger.balances(), ledger.spent(),
+                                    ledger.spent_ids())
+
+    def _restore_ledger(self, verifier):
+        """
+        Restores the ledger from the newest checkpoint still matching the
+        block store and replays the blocks stored after it, verifying them if
+        a verifier is given.
+        """
+        def accept(height, tip):
+            return height <= self._store.height() and \
+                self._store.digest(height - 1) == tip
+
+        state = self._checkpoints.newest(accept)
+        if state is None:
+            logging.debug("No checkpoint found, replaying the blockchain")
+            height = 0
+            ledger = Ledger()
+        else:
+            logging.debug("Replaying blocks from checkpoint(height={})".
+                          format(state['height']))
+            height = state['height']
+            ledger = Ledger(state['balances'], state['spent'], height,
+                            state['spent_ids'])
+
+        blocks = self._store.blocks(height)
+        if verifier is not None:
+            previous = self._store.digest(height - 1) if height > 0 \
+                else Block.GENESIS
+            assume_valid_height = None
+            if verifier.assume_valid() is not None:
+                assume_valid_height = self._digest_index().get(
+                    verifier.assume_valid())
+            blocks = verifier.verify(blocks, height, previous, ledger,
+                                     assume_valid_height)
+
+        for block in blocks:
+            ledger.apply_block(block)
+        return ledger
+
+    @staticmethod
+    def block_store_path(database):
+        """
+        The path of the block store kept next to a public storage file.
+        """
+        return database + '-blocks'
+
     def load_private(self, database, password):
         """
         Loads the private storage from a file. The file is in JSON format,
@@ -145,8 +282,28 @@ class QuantCoin:
         Obtains the blockchain.
         """
         logging.debug("All blocks requested")
+        if self._blocks is None:
+            with self._lock:
+                if self._blocks is None:
+                    self._blocks = list(self._store.blocks())
         return self._blocks
 
+    def height(self):
+        """
+        Obtains the number of blocks in the blockchain.
+        """
+        if self._blocks is None:
+            return self._store.height()
+        return len(self._blocks)
+
+    def last_block(self):
+        """
+        Obtains the last block of the blockchain, None if it is empty.
+        """
+        if self._blocks is None:
+            return self._store.tip()
+        return self._blocks[-1] if len(self._blocks) > 0 else None
+
     def block(self, start, end):
         """
         Obtains part of the blockchain.
@@ -158,8 +315,124 @@ class QuantCoin:
         """
         logging.debug("Block range requested(from={},to={})".
                       format(start, end))
+        if self._blocks is None:
+            return [self._store.block(height)
+                    for height in xrange(*self._range(start, end))]
         return self._blocks[start:end]
 
+    def block_at(self, height):
+        """
+        Obtains the block at a height of the blockchain.
+
+        :param height: the height of the block, 0 being the first block.
+
+        :returns the block, None if the blockchain is not that high.
+        """
+        if height < 0 or height >= self.height():
+            return None
+        if self._blocks is None:
+            return self._store.block(height)
+        return self._blocks[height]
+
+    def digest_at(self, height):
+        """
+        Obtains the digest of the block at a height of the blockchain, without
+        reading the block when it is kept in a block store.
+
+        :param height: the height of the block, 0 being the first block.
+
+        :returns the digest encoded in base64, None if the blockchain is not
+                 that high.
+        """
+        if height < 0 or height >= self.height():
+            return None
+        if self._blocks is None:
+            return binascii.b2a_base64(self._store.digest(height))
+        return self._blocks[height].digest()
+
+    def block_by_digest(self, digest):
+        """
+        Obtains a block by its digest.
+
+        :param digest: the digest of the block encoded in base64.
+
+        :returns the block, None if it is not in the blockchain.
+        """
+        height = self.height_of(digest)
+        return self.block_at(height) if height is not None else None
+
+    def height_of(self, digest):
+        """
+        Obtains the height of a block by its digest.
+
+        :param digest: the digest of the block encoded in base64.
+
+        :returns the height, None if the block is not in the blockchain.
+        """
+        try:
+            raw_digest = binascii.a2b_base64(digest)
+        except binascii.Error:
+            return None
+        return self._digest_index().get(raw_digest)
+
+    def has_block(self, digest):
+        """
+        True if a block with this digest, encoded in base64, is stored.
+        """
+        return self.height_of(digest) is not None
+
+    def block_of_transaction(self, txid):
+        """
+        Finds the block that included a transaction.
+
+        :param txid: the identifier of the transaction.
+
+        :returns the block, None if the transaction is not in the blockchain.
+        """
+        height = self.ledger().spent_height(txid)
+        return self.block_at(height) if height is not None else None
+
+    def _digest_index(self):
+        """
+        Obtains the index of block heights by raw digest. With a block store
+        the index is built from the store index when first needed.
+        """
+        if self._heights is None:
+            with self._lock:
+                if self._heights is None:
+                    self._heights = dict((self._store.digest(height), height)
+                                         for height in
+                                         xrange(self._store.height()))
+        return self._heights
+
+    def raw_blocks(self, start, end):
+        """
+        Obtains part of the blockchain encoded in JSON, one string or buffer
+        per block. When the blocks are kept in a block store the buffers are
+        read straight from the store without building any block.
+
+        :param start: the start point of blocks requested.
+        :param end: the index of the last block requested.
+        """
+        if self._store is None:
+            return [json.dumps(block.json())
+                    for block in self._blocks[start:end]]
+        return self._store.raw_range(*self._range(start, end))
+
+    def _range(self, start, end):
+        """
+        Resolves a slice of the blockchain to the heights it covers.
+        """
+        start, end, _ = slice(start, end).indices(self.height())
+        return start, max(start, end)
+
+    def lock(self):
+        """
+        The lock held while a block is stored. Holding it keeps the blockchain
+        and the ledger still, so a block can be checked against them.
+        """
+        return self._lock
+
     def wallets(self):
         """
         Obtains the wallets of this node.
@@ -173,12 +446,77 @@ class QuantCoin:
         if wallet not in self._wallets:
             self._wallets.append(wallet)
 
-    def store_block(self, block):
+    def store_block(self, block, height=None):
         """
         Store a new block in this node.
+
+        :param height: the height the block was validated at. The block is
+                stored only if the blockchain is still that high, so two
+                blocks validated concurrently on top of the same block are
+                not both stored. The block is stored on top of the last one
+                if not informed.
+
+        :returns True if the block was stored, False if it was already known
+                 or the blockchain grew since it was validated.
+        """
+        with self._lock:
+            heights = self._digest_index()
+            if block.raw_digest() in heights:
+                return False
+            if height is not None and height != self.height():
+                return False
+
+            height = self.height()
+            heights[block.raw_digest()] = height
+            if self._blocks is not None:
+                self._blocks.append(block)
+            if self._store is not None:
+                self._store.append(block)
+            if self._ledger is not None:
+                self._ledger.apply_block(block)
+                if (height + 1) % self._checkpoint_interval == 0:
+                    self.checkpoint()
+            return True
+
+    def extend(self, blocks, verifier, assume_valid_height=None):
         """
-        if block not in self._blocks:
-            self._blocks.append(block)
+        Verifies and stores blocks received from a peer. The blocks already
+        known are skipped, the others must extend the blockchain in order.
+        The blocks are stored up to the first invalid one.
+
+        :param blocks: the blocks received, in chain order.
+        :param verifier: the ChainVerifier checking the blocks.
+        :param assume_valid_height: the height of the assume valid block when
+                it is not stored yet, as told by the peers. The height of the
+                stored block prevails.
+
+        :returns the number of blocks stored.
+        """
+        with self._lock:
+            heights = self._digest_index()
+            blocks = [block for block in blocks
+                      if block.raw_digest() not in heights]
+            if len(blocks) == 0:
+                return 0
+
+            height = self.height()
+            last_block = self.last_block()
+            previous = last_block.raw_digest() if last_block is not None \
+                else Block.GENESIS
+            assume_valid_height = heights.get(verifier.assume_valid(),
+                                              assume_valid_height)
+
+            stored = 0
+            try:
+                for block in verifier.verify(blocks, height, previous,
+                                             self.ledger(),
+                                             assume_valid_height):
+                    self.store_block(block)
+                    stored += 1
+            except InvalidBlock as e:
+                logging.debug("Blocks rejected: {}".format(e))
+
+            return stored
 
     def store_node(self, node):
         """
@@ -214,27 +552,39 @@ class QuantCoin:
         }
         return wallet
 
+    def ledger(self):
+        """
+        Obtains the ledger with the balance of every address. The ledger is
+        built from the blockchain when first requested and kept up to date
+        as blocks are stored.
+        """
+        if self._ledger is None:
+            with self._lock:
+                if self._ledger is None:
+                    self._ledger = Ledger.from_blocks(self._iter_blocks())
+        return self._ledger
+
+    def check_ledger(self):
+        """
+        Rebuilds the ledger from the blockchain and compares it with the live
+        one.
+
+        :returns the (live, rebuilt) balances that differ, by address.
+        """
+        with self._lock:
+            return self.ledger().check(self._iter_blocks())
+
     def amount_owned(self, wallet):
         """
-        Calculates the amount owned by a wallet. This function is O(n^3) so
-        call this with caution.
-        """
-        amount_owned = 0.0
-        for block in self.blocks():
-            # if this wallet is the author of the block, all commissions should be his
-            if block.author() == wallet:
-                amount_owned += block.commission()
-
-            for transaction in block.transactions():
-                if wallet == transaction.from_wallet():
-                    amount_owned = amount_owned - transaction.amount_spent()
-                else:
-                    for transaction_wallet, amount in \
-                            transaction.to_wallets():
-                        # There are no restriction as to what one can send
-                        # money to a wallet in different amounts all in the
-                        # same transaction
-                        if transaction_wallet == wallet:
-                            amount_owned = amount_owned + amount
-
-        return amount_owned
+        Calculates the amount owned by a wallet.
+        """
+        return self.ledger().balance(wallet)
+
+    def _iter_blocks(self):
+        """
+        Iterates over the blockchain without loading the whole of it when the
+        blocks are kept in a block store.
+        """
+        if self._blocks is None:
+            return self._store.blocks()
+        return iter(self._blocks)
@@ -0,0 +1,354 @@
+import collections
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import framing
+
+
+class _Connection(object):
+    """
+    The state of a connection owned by the event loop.
+    """
+
+    def __init__(self, sock, address, deadline):
+        self.sock = sock
+        self.address = address
+        self.deadline = deadline
+        self.started = None
+        self.decoder = framing.FrameDecoder()
+        self.frames = collections.deque()
+        self.pending = ''
+
+
+class EventLoopServer(object):
+    """
+    An EventLoopServer accepts the connections of the peers and reads their
+    commands in a single thread, multiplexing the sockets with select, so a
+    burst of connections does not create a thread for each one.
+
+    Commands answered from memory run in the loop and their responses are
+    written by it. The other commands, like the validation of a block or the
+    ones talking to other peers, run in a bounded pool of threads, which
+    owns the connection and writes the response on it until the command is
+    handled.
+
+    Connections are persistent, a peer sends its commands one after the
+    other on the same connection and they are handled in order. The number
+    of open connections is limited, the server stops accepting while at the
+    limit and the pending connections wait in the listen backlog. A
+    connection that takes longer than the read timeout to send a command, or
+    stays idle longer than the idle timeout, is closed.
+
+    A peer may open a connection with a hello command to negotiate the
+    compression of the frames, the server then compresses its responses
+    above the compression threshold. The hello is handled by the server
+    itself, a peer that does not send it gets uncompressed frames.
+    """
+
+    DEFAULT_MAX_CONNECTIONS = 512
+    DEFAULT_READ_TIMEOUT = 10.0
+    DEFAULT_IDLE_TIMEOUT = 120.0
+    DEFAULT_WORKERS = 4
+    LISTEN_BACKLOG = 128
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, ip, port, commands, inline_commands=(),
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 read_timeout=DEFAULT_READ_TIMEOUT, workers=DEFAULT_WORKERS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 compression_level=framing.DEFAULT_COMPRESSION_LEVEL,
+                 compression_threshold=framing.DEFAULT_COMPRESSION_THRESHOLD):
+        """
+        Instantiates a server.
+
+        :param commands: the handlers by command name. A handler is called
+                with the command data and the connection, None for inline
+                commands, and returns the response or None.
+        :param inline_commands: the names of the cheap commands run by the
+                event loop itself.
+        :param max_connections: the maximum number of open connections.
+        :param read_timeout: the time a peer has to send a command, in seconds.
+        :param workers: the number of threads running the other commands.
+        :param idle_timeout: the time a connection is kept without commands,
+                in seconds.
+        :param compression_level: the zlib level of the frames compressed,
+                None if the compression is never accepted.
+        :param compression_threshold: the size of the smallest response
+                compressed, in bytes.
+        """
+        self._ip = ip
+        self._port = port
+        self._commands = commands
+        self._inline_commands = frozenset(inline_commands)
+        self._max_connections = max_connections
+        self._read_timeout = read_timeout
+        self._workers = workers
+        self._idle_timeout = idle_timeout
+        self._compression_level = compression_level
+        self._compression_threshold = compression_threshold
+        self._executor = None
+        self._connections = {}
+        self._executing = 0
+        self._executing_lock = threading.Lock()
+        self._returned = collections.deque()
+        self._running = False
+        self._wakeup = None
+
+    def run(self):
+        """
+        Runs the event loop until stopped.
+        """
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self._ip, self._port))
+        listener.listen(self.LISTEN_BACKLOG)
+        listener.setblocking(0)
+        self._wakeup = os.pipe()
+        self._executor = ThreadPool(self._workers)
+        self._running = True
+        try:
+            while self._running:
+                self._poll(listener)
+        finally:
+            for connection in self._connections.values():
+                connection.sock.close()
+            self._connections.clear()
+            with self._executing_lock:
+                while self._returned:
+                    self._returned.popleft().sock.close()
+            self._executor.close()
+            self._executor = None
+            listener.close()
+            os.close(self._wakeup[0])
+            os.close(self._wakeup[1])
+            self._wakeup = None
+
+    def stop(self):
+        """
+        Stops the event loop.
+        """
+        self._running = False
+        self._wake()
+
+    def connections(self):
+        """
+        The number of open connections, the ones being handled by the pool
+        included.
+        """
+        return len(self._connections) + self._executing
+
+    def _poll(self, listener):
+        self._resume()
+        readers = [self._wakeup[0]] + [connection.sock for connection
+                                       in self._connections.values()
+                                       if not connection.pending]
+        if self.connections() < self._max_connections:
+            readers.append(listener)
+        writers = [connection.sock for connection in self._connections.values()
+                   if connection.pending]
+
+        readable, writable, _ = select.select(readers, writers, [],
+                                              self.POLL_INTERVAL)
+        for sock in readable:
+            if sock is listener:
+                self._accept(listener)
+            elif sock == self._wakeup[0]:
+                os.read(self._wakeup[0], 1024)
+            elif sock in self._connections:
+                self._read(self._connections[sock])
+        for sock in writable:
+            if sock in self._connections:
+                self._write(self._connections[sock])
+
+        now = time.time()
+        for connection in self._connections.values():
+            if connection.deadline < now:
+                logging.debug("Connection timed out(address={})".
+                              format(connection.address))
+                self._close(connection)
+
+    def _accept(self, listener):
+        while self.connections() < self._max_connections:
+            try:
+                sock, address = listener.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            logging.debug("handling connection(address={})".format(address))
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connections[sock] = _Connection(
+                sock, address, time.time() + self._idle_timeout)
+
+    def _resume(self):
+        """
+        Takes back the connections whose commands were handled by the pool
+        and handles the commands they sent meanwhile.
+        """
+        while self._returned:
+            connection = self._returned.popleft()
+            connection.sock.setblocking(0)
+            self._connections[connection.sock] = connection
+            self._next(connection)
+
+    def _read(self, connection):
+        try:
+            data = connection.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self._close(connection)
+            return
+
+        try:
+            connection.frames.extend(connection.decoder.feed(data))
+        except framing.FramingError as e:
+            logging.debug("Invalid frame received(address={}). {}".
+                          format(connection.address, e))
+            self._close(connection)
+            return
+
+        # A command started must be completed within the read timeout
+        if connection.decoder.buffered() > 0 and connection.started is None:
+            connection.started = time.time()
+            connection.deadline = min(connection.deadline,
+                                      connection.started + self._read_timeout)
+        self._next(connection)
+
+    def _next(self, connection):
+        """
+        Handles the next command received on a connection, if there is one
+        and the response to the previous one was written.
+        """
+        if connection.pending:
+            return
+        if not connection.frames:
+            now = time.time()
+            if connection.decoder.buffered() == 0:
+                connection.started = None
+                connection.deadline = now + self._idle_timeout
+            elif connection.started is None:
+                connection.started = now
+                connection.deadline = now + self._read_timeout
+            return
+
+        connection.started = None
+        try:
+            data = json.loads(connection.frames.popleft())
+            if data['cmd'] == 'hello':
+                self._hello(connection, data)
+                return
+            command = self._commands[data['cmd']]
+        except (ValueError, KeyError, TypeError) as e:
+            logging.debug("Invalid command received(address={}). {}".
+                          format(connection.address, e))
+            self._close(connection)
+            return
+
+        if data['cmd'] not in self._inline_commands:
+            del self._connections[connection.sock]
+            with self._executing_lock:
+                self._executing += 1
+            self._executor.apply_async(self._execute, (command, data,
+                                                       connection))
+            return
+
+        try:
+            response = command(data, None)
+            connection.pending = framing.encode(
+                response, connection.decoder.compression) \
+                if response is not None else ''
+        except Exception as e:
+            logging.debug("An exception occurred on connection handle" +
+                          "(address={}). {}".format(connection.address, e))
+            self._close(connection)
+            return
+
+        if connection.pending:
+            connection.deadline = time.time() + self._read_timeout
+            self._write(connection)
+        else:
+            self._next(connection)
+
+    def _hello(self, connection, data):
+        """
+        Negotiates the compression of a connection. The response is not
+        compressed, the frames that follow are, both ways.
+        """
+        offered = data.get('compression', [])
+        algorithm = framing.Compression.ALGORITHM
+        accepted = algorithm if self._compression_level is not None and \
+            isinstance(offered, list) and algorithm in offered else None
+        logging.debug("Hello received(address={}, compression={})".
+                      format(connection.address, accepted))
+        connection.pending = framing.encode(
+            json.dumps({'compression': accepted}))
+        if accepted is not None:
+            compression = framing.Compression(connection.address[0],
+                                              self._compression_level,
+                                              self._compression_threshold)
+            connection.decoder.compression = compression
+            framing.enable_compression(connection.sock, compression)
+        connection.deadline = time.time() + self._read_timeout
+        self._write(connection)
+
+    def _write(self, connection):
+        try:
+            sent = connection.sock.send(connection.pending)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._close(connection)
+            return
+        connection.pending = connection.pending[sent:]
+        if not connection.pending:
+            self._next(connection)
+
+    def _execute(self, command, data, connection):
+        """
+        Runs a command in a thread of the pool. The connection is switched to
+        blocking mode, with the read timeout, for the handler to use, and
+        given back to the event loop afterwards. A connection whose command
+        failed is closed, the peer may be waiting for a response.
+        """
+        reusable = False
+        try:
+            connection.sock.setblocking(1)
+            connection.sock.settimeout(self._read_timeout)
+            response = command(data, connection.sock)
+            if response is not None:
+                framing.send_frame(connection.sock, response)
+            reusable = True
+        except Exception as e:
+            logging.debug("An exception occurred on connection handle" +
+                          "(address={}). {}".format(connection.address, e))
+        finally:
+            with self._executing_lock:
+                self._executing -= 1
+                if reusable and self._running:
+                    self._returned.append(connection)
+                else:
+                    connection.sock.close()
+            self._wake()
+
+    def _wake(self):
+        wakeup = self._wakeup
+        if wakeup is not None:
+            try:
+                os.write(wakeup[1], 'x')
+            except OSError:
+                pass
+
+    def _close(self, connection):
+        self._connections.pop(connection.sock, None)
+        connection.sock.close()
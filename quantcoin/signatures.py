@@ -0,0 +1,146 @@
+import binascii
+import collections
+import hashlib
+import threading
+
+from ecdsa import BadSignatureError, SECP256k1, VerifyingKey
+
+
+class SignatureCache(object):
+    """
+    A SignatureCache remembers the outcome of the ECDSA verification of
+    transactions, so a transaction received alone and later inside a block is
+    verified only once. It also keeps the parsed public keys, decoding a key
+    is almost as expensive as checking a signature.
+
+    Both caches are bounded and evict the least recently used entries.
+    """
+
+    DEFAULT_SIZE = 100000
+    DEFAULT_KEYS_SIZE = 10000
+
+    def __init__(self, size=DEFAULT_SIZE, keys_size=DEFAULT_KEYS_SIZE):
+        """
+        Instantiates a signature cache.
+
+        :param size: the maximum number of verification results kept.
+        :param keys_size: the maximum number of parsed public keys kept.
+        """
+        self._size = size
+        self._keys_size = keys_size
+        self._verified = collections.OrderedDict()
+        self._keys = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def verify(self, transaction):
+        """
+        Verifies the signature of a transaction, using the result of a
+        previous verification of the same transaction if there is one.
+
+        :returns True if the signature is authentic.
+        """
+        if transaction.public_key() is None or transaction.signature() is None:
+            return False
+
+        verified = self.cached(transaction)
+        if verified is not None:
+            return verified
+
+        try:
+            public_key = self.verifying_key(transaction.public_key())
+            verified = public_key.verify(
+                signature=binascii.a2b_base64(transaction.signature()),
+                data=transaction.prepare_for_signature(),
+                hashfunc=hashlib.sha256)
+        except (BadSignatureError, AssertionError, binascii.Error):
+            verified = False
+
+        self.store(transaction, verified)
+        return verified
+
+    def cached(self, transaction):
+        """
+        Obtains the outcome of a previous verification of a transaction,
+        counting a hit or a miss.
+
+        :returns True or False if the transaction was verified, None if not.
+        """
+        entry = self._entry(transaction)
+        with self._lock:
+            verified = self._verified.pop(entry, None)
+            if verified is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._verified[entry] = verified
+            return verified
+
+    def peek(self, transaction):
+        """
+        Obtains the outcome of a previous verification of a transaction
+        without counting a hit or a miss, nor refreshing the entry.
+
+        :returns True or False if the transaction was verified, None if not.
+        """
+        entry = self._entry(transaction)
+        with self._lock:
+            return self._verified.get(entry)
+
+    def miss(self, count=1):
+        """
+        Counts verifications that checked the signature without going through
+        the cache, like the ones made by worker processes.
+        """
+        with self._lock:
+            self._misses += count
+
+    def store(self, transaction, verified):
+        """
+        Records the outcome of the verification of a transaction made
+        elsewhere, like in a worker process.
+        """
+        with self._lock:
+            self._verified[self._entry(transaction)] = verified
+            while len(self._verified) > self._size:
+                self._verified.popitem(last=False)
+
+    def verifying_key(self, public_key):
+        """
+        Obtains the parsed public key from its base64 encoding.
+        """
+        with self._lock:
+            key = self._keys.pop(public_key, None)
+            if key is not None:
+                self._keys[public_key] = key
+                return key
+
+        key = VerifyingKey.from_string(binascii.a2b_base64(public_key),
+                                       curve=SECP256k1)
+        with self._lock:
+            self._keys[public_key] = key
+            while len(self._keys) > self._keys_size:
+                self._keys.popitem(last=False)
+
+        return key
+
+    @staticmethod
+    def _entry(transaction):
+        return (transaction.txid(), transaction.signature(),
+                transaction.public_key())
+
+    def hits(self):
+        """
+        The number of verifications answered from the cache.
+        """
+        return self._hits
+
+    def misses(self):
+        """
+        The number of verifications that checked the signature.
+        """
+        return self._misses
+
+
+signature_cache = SignatureCache()
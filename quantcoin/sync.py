@@ -0,0 +1,201 @@
+import binascii
+import logging
+import threading
+
+from block import Block
+from download import DownloadScheduler
+from node import Network
+
+
+class Synchronizer(object):
+    """
+    A Synchronizer keeps the blockchain of a node up to date with the peers
+    downloading only the blocks it lacks, instead of the whole chain of every
+    peer on each update.
+
+    The peers are asked for their tip along with a block locator, the
+    digests of the last blocks of this node and then of blocks further and
+    further apart down to the first one. A peer answers with its height and
+    the number of blocks both chains have in common, so a peer ahead of this
+    node is asked for the missing suffix only, over the same connection.
+    When nothing is new an update costs a small message by peer.
+
+    The suffix is downloaded by a DownloadScheduler, in chunks split among
+    every peer found ahead, and the blocks are verified and stored in height
+    order. A peer on a fork, one lacking the tip of this node, is skipped:
+    the blockchain is only ever extended.
+
+    The peers also tell the height of the assume valid block of the
+    verifier, so the signatures of the chunks below it are not checked
+    before the block is stored. The height is used only if every peer of the
+    download tells the same, and the chunk holding it must hold the assume
+    valid block there, otherwise it is rejected and the signatures are
+    checked again.
+    """
+
+    # The number of consecutive blocks at the top of the locator, the gap
+    # between the next ones doubles each time
+    DENSE_LOCATOR = 10
+
+    def __init__(self, quantcoin, network, verifier,
+                 chunk_size=DownloadScheduler.DEFAULT_CHUNK_SIZE,
+                 stall_timeout=DownloadScheduler.DEFAULT_STALL_TIMEOUT):
+        """
+        Instantiates a synchronizer.
+
+        :param quantcoin: The QuantCoin storages facade.
+        :param network: The Network used to reach the peers.
+        :param verifier: The ChainVerifier checking the blocks received.
+        :param chunk_size: the number of blocks asked to a peer at once.
+        :param stall_timeout: the time to wait for a chunk before asking it
+                to another peer as well, in seconds.
+        """
+        self._quantcoin = quantcoin
+        self._network = network
+        self._verifier = verifier
+        self._chunk_size = chunk_size
+        self._stall_timeout = stall_timeout
+        self._located = 0
+        self._scheduler = None
+        self._assume_valid_heights = set()
+        self._broken = set()
+        self._lock = threading.Lock()
+        self._extend_lock = threading.Lock()
+
+    def sync(self):
+        """
+        Asks the peers for their tip, the blocks lacking are downloaded when
+        the tips are received. Nothing is asked while a download is running,
+        the peers already in it would join it again over new connections.
+        """
+        if self.downloading():
+            logging.debug("Download running, tips not asked(height={})".
+                          format(self._scheduler.delivered()))
+            return
+
+        self._located = self._quantcoin.height()
+        assume_valid = self._verifier.assume_valid()
+        self._network.get_tip(self.locator(), self._tip_handler,
+                              binascii.b2a_base64(assume_valid)
+                              if assume_valid is not None else None)
+
+    def locator(self):
+        """
+        Builds the block locator of the blockchain: the digests of the last
+        blocks, from the tip backwards, and of blocks exponentially further
+        apart down to the first block.
+        """
+        heights = []
+        height = self._quantcoin.height() - 1
+        step = 1
+        while height > 0:
+            heights.append(height)
+            if len(heights) >= self.DENSE_LOCATOR:
+                step *= 2
+            height -= step
+        if self._quantcoin.height() > 0:
+            heights.append(0)
+        return [self._quantcoin.digest_at(height) for height in heights]
+
+    def downloading(self):
+        """
+        True if blocks are being downloaded from the peers.
+        """
+        scheduler = self._scheduler
+        return scheduler is not None and not scheduler.done() and \
+            scheduler.peers() > 0
+
+    def _tip_handler(self, tip, connection):
+        """
+        Handles the tip of a peer, joining it to the download of the blocks
+        beyond the tip of this node. The download starts with the first peer
+        found ahead and the others join it while it runs, each one fetching
+        chunks over its own connection until none is left.
+        """
+        height = self._quantcoin.height()
+        if tip['height'] <= height:
+            return
+        if tip['common'] < self._located:
+            logging.debug("Peer on a fork(height={}, common={})".
+                          format(tip['height'], tip['common']))
+            return
+
+        with self._lock:
+            if self._scheduler is None or self._scheduler.done() or \
+                    self._scheduler.peers() == 0:
+                # The chain may have grown meanwhile, the blocks already
+                # stored are not asked for again
+                self._scheduler = DownloadScheduler(
+                    self._fetch, self._deliver, self._quantcoin.height(),
+                    self._chunk_size, self._stall_timeout, max_failures=1)
+                self._assume_valid_heights = set()
+            assume_valid_height = tip.get('assume_valid_height')
+            if isinstance(assume_valid_height, (int, long)) and \
+                    0 <= assume_valid_height < tip['height']:
+                self._assume_valid_heights.add(assume_valid_height)
+            scheduler = self._scheduler
+            scheduler.add_peer(connection, tip['height'])
+
+        fetched = scheduler.work(connection)
+        logging.debug("Peer download finished(chunks={}, height={})".
+                      format(fetched, scheduler.delivered()))
+        # A connection left in the middle of a response cannot be reused
+        if connection in self._broken:
+            self._broken.discard(connection)
+            raise Exception("Download failed")
+
+    def _fetch(self, connection, start, end):
+        """
+        Downloads a chunk of blocks from a peer.
+        """
+        blocks = []
+        try:
+            Network.fetch_blocks(connection, start, end, blocks.extend)
+        except Exception:
+            self._broken.add(connection)
+            raise
+        return blocks
+
+    def _assume_valid_height(self):
+        """
+        The height of the assume valid block told by the peers, None if
+        they told none or disagree.
+        """
+        with self._lock:
+            if len(self._assume_valid_heights) != 1:
+                return None
+            return next(iter(self._assume_valid_heights))
+
+    def _deliver(self, start, block_data):
+        """
+        Verifies and stores a chunk of blocks received from a peer. A chunk
+        holding the height told for the assume valid block must hold that
+        block there.
+
+        :returns True if every block is valid.
+        """
+        try:
+            blocks = [Block.from_json(block) for block in block_data]
+        except (KeyError, TypeError, AttributeError, binascii.Error) as e:
+            logging.debug("Malformed blocks received. {}".format(e))
+            return False
+
+        assume_valid_height = self._assume_valid_height()
+        if assume_valid_height is not None and \
+                start <= assume_valid_height < start + len(blocks) and \
+                blocks[assume_valid_height - start].raw_digest() != \
+                self._verifier.assume_valid():
+            logging.warn("Assume valid block not found at the height told "
+                         "by the peers({})".format(assume_valid_height))
+            # The height is not used for the rest of the download
+            with self._lock:
+                self._assume_valid_heights.clear()
+                self._assume_valid_heights.add(None)
+            return False
+
+        with self._extend_lock:
+            stored = self._quantcoin.extend(blocks, self._verifier,
+                                            assume_valid_height)
+        logging.debug("Blocks synced(received={}, stored={})".
+                      format(len(blocks), stored))
+        return not blocks or self._quantcoin.has_block(blocks[-1].digest())
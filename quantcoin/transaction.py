@@ -2,7 +2,10 @@ import binascii
 import hashlib
 import json
 
-from ecdsa import SECP256k1, SigningKey, VerifyingKey
+from ecdsa import SECP256k1, SigningKey
+from ecdsa.util import sigdecode_string, sigencode_string
+
+from signatures import signature_cache
 
 
 class Transaction(object):
@@ -37,6 +40,20 @@ class Transaction(object):
         self._to_wallets = to_wallets
         self._signature = signature
         self._public_key = public_key
+        self._txid = None
+        self._spend_id = None
+
+    @staticmethod
+    def from_json(data):
+        """
+        Parses a JSON of a transaction.
+
+        :returns The transaction instance represented by the JSON object.
+        """
+        return Transaction(data['body']['from'],
+                           data['body']['to'],
+                           data['signature'],
+                           data['public_key'])
 
     def json(self):
         """
@@ -53,6 +70,67 @@ class Transaction(object):
 
         return dictionary
 
+    def serialize(self):
+        """
+        Canonical encoding of the signed transaction. The same transaction
+        always produces the same string, whatever the order of its keys.
+        """
+        return json.dumps(self.json(), sort_keys=True)
+
+    def txid(self):
+        """
+        The identifier of this transaction, the hexadecimal SHA256 of its
+        canonical encoding. It is computed once and kept.
+        """
+        if self._txid is None:
+            self._txid = hashlib.sha256(self.serialize()).hexdigest()
+        return self._txid
+
+    def spend_id(self):
+        """
+        The identifier of the payment made by this transaction, the same for
+        every encoding of it. The txid hashes the base64 text of the signature
+        and of the public key, which can be re-encoded without breaking the
+        signature, and an ECDSA signature (r, s) is as valid as (r, n - s).
+        The spend id hashes the signed data with the decoded public key and
+        the signature normalized to the lower s, so a confirmed transaction
+        re-sent in another form is still caught. It is computed once and
+        kept.
+        """
+        if self._spend_id is None:
+            identity = json.dumps([self.prepare_for_signature(),
+                                   self._canonical_public_key(),
+                                   self._canonical_signature()])
+            self._spend_id = hashlib.sha256(identity).hexdigest()
+        return self._spend_id
+
+    def _canonical_public_key(self):
+        """
+        The hexadecimal public key, the raw text if it cannot be decoded.
+        """
+        if self._public_key is None:
+            return None
+        try:
+            return binascii.hexlify(binascii.a2b_base64(self._public_key))
+        except (binascii.Error, TypeError, ValueError):
+            return self._public_key
+
+    def _canonical_signature(self):
+        """
+        The hexadecimal signature with the lower of s and n - s, the raw text
+        if it cannot be decoded.
+        """
+        if self._signature is None:
+            return None
+        order = SECP256k1.order
+        try:
+            r, s = sigdecode_string(binascii.a2b_base64(self._signature),
+                                    order)
+        except (binascii.Error, TypeError, ValueError, AssertionError):
+            return self._signature
+        return binascii.hexlify(sigencode_string(r, min(s, order - s),
+                                                 order))
+
     def from_wallet(self):
         """
         Retrieves the sender of the transaction
@@ -123,21 +201,16 @@ class Transaction(object):
         """
         self._signature = signature
         self._public_key = public_key
+        self._txid = None
+        self._spend_id = None
 
     def verify(self):
         """
-        Verifies the transaction proof of authenticity
+        Verifies the transaction proof of authenticity. The outcome is kept in
+        the shared signature cache, so the signature is checked only once.
         :return: True if the transaction is authentic
         """
-        if self._public_key is not None:
-            to_verify = self.prepare_for_signature()
-            pub_key = VerifyingKey.from_string(binascii.a2b_base64(self._public_key),
-                                               curve=SECP256k1)
-            return pub_key.verify(signature=binascii.a2b_base64(self.signature()),
-                                  data=to_verify,
-                                  hashfunc=hashlib.sha256)
-        else:
-            return False
+        return signature_cache.verify(self)
 
     def signature(self):
         """
@@ -150,3 +223,15 @@ class Transaction(object):
         Obtains the public key of the transaction
         """
         return self._public_key
+
+    def __eq__(self, other):
+        if not isinstance(other, Transaction):
+            return False
+
+        return self.txid() == other.txid()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.txid())
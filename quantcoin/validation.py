@@ -0,0 +1,395 @@
+import binascii
+import collections
+import hashlib
+import logging
+import multiprocessing
+import time
+
+from block import Block
+from signatures import signature_cache
+from transaction import Transaction
+
+
+class InvalidBlock(Exception):
+    """
+    Raised when a block of a chain being verified breaks a rule.
+    """
+
+    def __init__(self, height, reason):
+        Exception.__init__(self, "Invalid block at height {}: {}".
+                           format(height, reason))
+        self.height = height
+        self.reason = reason
+
+
+def network_difficulty(height):
+    """
+    The difficulty required from the block at a height.
+    """
+    return int(52 - (50 / 1 + height // 100000))
+
+
+def creation_limit(height):
+    """
+    The amount of coins a block at a height is allowed to create.
+    """
+    return 100 / (1 + (height // 100000))
+
+
+def check_transactions(block, height, ledger):
+    """
+    Checks the rules of the transactions of a block that do not depend on
+    signatures: a transaction cannot be spent twice, a sender must own the
+    amount spent and cannot send money to itself, and there is at most one
+    coin creation transaction creating no more coins than allowed.
+
+    :param block: the block checked.
+    :param height: the height of the block.
+    :param ledger: the ledger with the balances before the block.
+
+    :returns the transactions that have a sender, whose signatures still
+             have to be verified.
+    :raises AssertionError: if a rule is broken.
+    """
+    has_coin_creation_transaction = False
+    signed_transactions = []
+    spend_ids = set()
+    for transaction in block.transactions():
+        # If the transaction is the creation transaction we do not validate
+        if transaction.from_wallet() is not None:
+            # Neither in an earlier block nor twice in this one, in any
+            # encoding
+            assert not ledger.is_spent(transaction)
+            assert transaction.spend_id() not in spend_ids
+            spend_ids.add(transaction.spend_id())
+
+            assert transaction.amount_spent() <= \
+                ledger.balance(transaction.from_wallet())
+
+            # An address cannot send money to itself
+            for to_address, _ in transaction.to_wallets():
+                assert to_address != transaction.from_wallet()
+
+            signed_transactions.append(transaction)
+        else:
+            assert not has_coin_creation_transaction
+            assert transaction.amount_spent() <= creation_limit(height)
+            # Only one coin creation transaction allowed
+            has_coin_creation_transaction = True
+
+    return signed_transactions
+
+
+def verify_transaction(transaction):
+    """
+    Checks that a transaction was created by the owner of the sending address:
+    the address must derive from the public key and the signature must be
+    authentic.
+
+    :returns True if the transaction passes both checks.
+    """
+    try:
+        public_key = signature_cache.verifying_key(transaction.public_key())
+    except Exception:
+        return False
+
+    address = 'QC' + hashlib.sha1(public_key.to_string()).hexdigest()
+    return address == transaction.from_wallet() and transaction.verify()
+
+
+def _verify_batch(batch):
+    """
+    Verifies a batch of transactions in a worker process.
+
+    :param batch: a list of (position, transaction JSON) tuples.
+
+    :returns the position of the first transaction that failed, None if all
+             of them passed.
+    """
+    for position, data in batch:
+        if not verify_transaction(Transaction.from_json(data)):
+            return position
+    return None
+
+
+def _verify_block(block, height, check_signatures):
+    """
+    Checks the parts of a block that do not depend on the rest of the chain:
+    the proof of work, which covers the Merkle root, and the signatures.
+
+    :returns the reason the block failed, None if it passed.
+    """
+    if not block.valid(network_difficulty(height)):
+        return "proof of work"
+    if check_signatures:
+        for transaction in block.transactions():
+            if transaction.from_wallet() is not None and \
+                    not verify_transaction(transaction):
+                return "signature of {}".format(transaction.txid())
+    return None
+
+
+def _verify_blocks(batch):
+    """
+    Verifies a batch of blocks in a worker process.
+
+    :param batch: a list of (height, block JSON, check signatures) tuples.
+
+    :returns the (height, reason) of the first block that failed, None if all
+             of them passed.
+    """
+    for height, data, check_signatures in batch:
+        reason = _verify_block(Block.from_json(data), height, check_signatures)
+        if reason is not None:
+            return height, reason
+    return None
+
+
+class SignatureVerifier(object):
+    """
+    A SignatureVerifier checks the signatures and sending addresses of the
+    transactions of a block. With more than one worker the checks are sent in
+    batches to a pool of processes, so a large block is verified by every
+    core. The outcome is the same of checking the transactions one by one:
+    the block fails on the first transaction that fails.
+
+    Transactions already in the signature cache are not sent to the workers,
+    and the ones verified by them are added to it. Every transaction is
+    counted once by the cache, as a hit or as a miss.
+    """
+
+    DEFAULT_BATCH_SIZE = 64
+
+    def __init__(self, workers=1, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Instantiates a signature verifier.
+
+        :param workers: the number of worker processes, 1 verifies in the
+                calling thread.
+        :param batch_size: the number of transactions sent to a worker at once.
+        """
+        self._workers = workers
+        self._batch_size = batch_size
+        self._pool = None
+
+    def verify(self, transactions):
+        """
+        Verifies a sequence of transactions.
+
+        :param transactions: the transactions, coin creation ones excluded.
+
+        :returns True if every transaction passed.
+        """
+        if self._workers <= 1:
+            return all(verify_transaction(transaction)
+                       for transaction in transactions)
+
+        cached, pending = [], []
+        for transaction in transactions:
+            if signature_cache.peek(transaction) is True:
+                cached.append(transaction)
+            else:
+                pending.append(transaction)
+        if len(pending) <= self._batch_size:
+            return all(verify_transaction(transaction)
+                       for transaction in transactions)
+
+        # The cache holds the signature only, the sending address of a cached
+        # transaction is still checked
+        if not all(verify_transaction(transaction) for transaction in cached):
+            return False
+
+        signature_cache.miss(len(pending))
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self._workers)
+
+        batches = []
+        for start in range(0, len(pending), self._batch_size):
+            batches.append([(position, pending[position].json())
+                            for position in
+                            range(start, min(start + self._batch_size,
+                                             len(pending)))])
+
+        for failed in self._pool.imap(_verify_batch, batches):
+            if failed is not None:
+                logging.debug("Transaction failed verification({})".
+                              format(pending[failed].txid()))
+                return False
+
+        for transaction in pending:
+            signature_cache.store(transaction, True)
+        return True
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+class ChainVerifier(object):
+    """
+    A ChainVerifier checks a sequence of blocks before it is added to the
+    blockchain, as on the initial load of the public storage and when syncing
+    from peers.
+
+    The blocks are verified in height ordered batches. The proof of work and
+    signatures of a batch do not depend on other blocks, they are checked by a
+    pool of processes while the previous batches are checked for linkage and
+    transaction rules, which must follow the chain order.
+
+    Below a configured assume valid block the signatures are not checked, the
+    proof of work of the blocks that follow it already vouches for them.
+    """
+
+    DEFAULT_BATCH_SIZE = 100
+    PROGRESS_INTERVAL = 10.0
+
+    def __init__(self, workers=1, batch_size=DEFAULT_BATCH_SIZE,
+                 assume_valid=None):
+        """
+        Instantiates a chain verifier.
+
+        :param workers: the number of worker processes, 1 verifies in the
+                calling thread.
+        :param batch_size: the number of blocks sent to a worker at once.
+        :param assume_valid: the digest, encoded in base64, of the block up to
+                which the signatures are not checked.
+        """
+        self._workers = workers
+        self._batch_size = batch_size
+        self._assume_valid = binascii.a2b_base64(assume_valid) \
+            if assume_valid is not None else None
+        self._pool = None
+
+    def assume_valid(self):
+        """
+        The raw digest of the assume valid block, None if not configured.
+        """
+        return self._assume_valid
+
+    def verify(self, blocks, height, previous, ledger,
+               assume_valid_height=None):
+        """
+        Verifies a sequence of blocks extending a chain. The blocks are
+        yielded in order as they pass, the caller must apply each one to the
+        ledger before asking for the next.
+
+        :param blocks: the blocks, in chain order.
+        :param height: the height of the first block.
+        :param previous: the raw digest of the block before the first one.
+        :param ledger: the ledger with the balances before the first block.
+        :param assume_valid_height: the height of the assume valid block if
+                already known. Otherwise it is searched in blocks when it is a
+                list.
+
+        :returns a generator of the verified blocks.
+        :raises InvalidBlock: when a block breaks a rule.
+        """
+        if assume_valid_height is None and self._assume_valid is not None \
+                and isinstance(blocks, list):
+            for index, block in enumerate(blocks):
+                if block.raw_digest() == self._assume_valid:
+                    assume_valid_height = height + index
+                    break
+
+        started = reported = time.time()
+        verified = 0
+        for batch_height, batch, failure in self._checked_batches(
+                blocks, height, assume_valid_height):
+            for offset, block in enumerate(batch):
+                block_height = batch_height + offset
+                if failure is not None and failure[0] == block_height:
+                    raise InvalidBlock(*failure)
+                if block.raw_digest() is None or \
+                        block.previous() != binascii.b2a_base64(previous):
+                    raise InvalidBlock(block_height, "previous block")
+                try:
+                    check_transactions(block, block_height, ledger)
+                except AssertionError:
+                    raise InvalidBlock(block_height, "transactions")
+
+                previous = block.raw_digest()
+                verified += 1
+                yield block
+
+            now = time.time()
+            if now - reported >= self.PROGRESS_INTERVAL:
+                logging.info("Verified {} blocks({:.1f} blocks/s)".
+                             format(verified, verified / (now - started)))
+                reported = now
+
+        elapsed = time.time() - started
+        if verified > 0:
+            logging.info("Verified {} blocks in {:.1f}s({:.1f} blocks/s)".
+                         format(verified, elapsed,
+                                verified / elapsed if elapsed > 0 else 0.0))
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _checked_batches(self, blocks, height, assume_valid_height):
+        """
+        Splits the blocks in batches and checks their proof of work and
+        signatures, in the worker processes if there are more than one. A
+        few batches are checked ahead of the one being yielded.
+
+        :returns a generator of (height, blocks, failure) tuples, failure being
+                 the (height, reason) of the first block of the batch that
+                 failed the checks, None if all of them passed.
+        """
+        def check_signatures(block_height):
+            return assume_valid_height is None or \
+                block_height > assume_valid_height
+
+        if self._workers <= 1:
+            for batch_height, batch in self._batches(blocks, height):
+                tasks = [(batch_height + offset, block,
+                          check_signatures(batch_height + offset))
+                         for offset, block in enumerate(batch)]
+                yield batch_height, batch, self._first_failure(tasks)
+            return
+
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self._workers)
+
+        pending = collections.deque()
+        for batch_height, batch in self._batches(blocks, height):
+            tasks = [(batch_height + offset, block.json(),
+                      check_signatures(batch_height + offset))
+                     for offset, block in enumerate(batch)]
+            pending.append((batch_height, batch,
+                            self._pool.apply_async(_verify_blocks, (tasks,))))
+            if len(pending) >= 2 * self._workers:
+                batch_height, batch, result = pending.popleft()
+                yield batch_height, batch, result.get()
+
+        while pending:
+            batch_height, batch, result = pending.popleft()
+            yield batch_height, batch, result.get()
+
+    @staticmethod
+    def _first_failure(tasks):
+        for block_height, block, check_signatures in tasks:
+            reason = _verify_block(block, block_height, check_signatures)
+            if reason is not None:
+                return block_height, reason
+        return None
+
+    def _batches(self, blocks, height):
+        batch = []
+        for block in blocks:
+            batch.append(block)
+            if len(batch) == self._batch_size:
+                yield height, batch
+                height += len(batch)
+                batch = []
+        if batch:
+            yield height, batch
@@ -0,0 +1,86 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'quantcoin'))
+
+from block import Block
+from blockstore import BlockStore
+from transaction import Transaction
+
+
+class BlockStoreRecoveryTest(unittest.TestCase):
+    """
+    A record torn by a crash must be truncated when the store is reopened,
+    without losing the blocks stored after it.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.blocks = []
+        previous = Block.GENESIS
+        for height in range(4):
+            digest = hashlib.sha256(str(height)).digest()
+            self.blocks.append(Block('QCauthor',
+                                     [Transaction(None,
+                                                  [('QCauthor', 50.0)])],
+                                     previous, height, digest))
+            previous = digest
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _store(self, blocks):
+        store = BlockStore(self.path, fsync_interval=1)
+        store.open()
+        for block in blocks:
+            store.append(block)
+        return store
+
+    def _segment_path(self):
+        return os.path.join(self.path, BlockStore.SEGMENT_PREFIX +
+                            "{:012d}".format(0) + BlockStore.SEGMENT_SUFFIX)
+
+    def _tear(self, stray):
+        """
+        Stores three blocks and appends the start of a record a crash did
+        not let complete.
+        """
+        self._store(self.blocks[:3]).close()
+        size = os.path.getsize(self._segment_path())
+        with open(self._segment_path(), 'ab') as fp:
+            fp.write(stray)
+        return size
+
+    def _recovered(self, size):
+        store = self._store([])
+        self.assertEqual(store.height(), 3)
+        self.assertEqual(os.path.getsize(self._segment_path()), size)
+
+        # The blocks appended afterwards survive losing their index entry
+        store.append(self.blocks[3])
+        store.close()
+        index_path = os.path.join(self.path, BlockStore.INDEX_NAME)
+        with open(index_path, 'r+b') as fp:
+            fp.truncate(3 * BlockStore.INDEX_ENTRY.size)
+
+        store = self._store([])
+        self.assertEqual(store.height(), 4)
+        self.assertEqual(store.block(3), self.blocks[3])
+        store.close()
+
+    def test_torn_header(self):
+        size = self._tear('\x00\x00\x01')
+        self._recovered(size)
+
+    def test_torn_payload(self):
+        size = self._tear(BlockStore.RECORD_HEADER.pack(100, 0) + '{"auth')
+        self._recovered(size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import binascii
+import os
+import sys
+import unittest
+
+from ecdsa import SECP256k1
+from ecdsa.util import sigdecode_string, sigencode_string
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'quantcoin'))
+
+from block import Block
+from ledger import Ledger
+from quantcoin import QuantCoin
+from transaction import Transaction
+from validation import check_transactions
+
+
+class ReplayTest(unittest.TestCase):
+    """
+    A confirmed transaction re-sent in another encoding must be caught as
+    spent.
+    """
+
+    def setUp(self):
+        self.sender = QuantCoin.create_wallet("replay sender")
+        self.receiver = QuantCoin.create_wallet("replay receiver")
+        self.transaction = Transaction(self.sender['address'],
+                                       [(None, 0.1),
+                                        (self.receiver['address'], 1.0)])
+        self.transaction.sign(self.sender['private_key'],
+                              self.sender['public_key'])
+        self.ledger = Ledger({self.sender['address']: 100.0})
+        self.ledger.apply_block(Block('QCauthor', [self.transaction],
+                                      Block.GENESIS))
+
+    def _replayed(self, signature, public_key=None):
+        data = self.transaction.json()
+        data['signature'] = signature
+        if public_key is not None:
+            data['public_key'] = public_key
+        replay = Transaction.from_json(data)
+        self.assertNotEqual(replay.txid(), self.transaction.txid())
+        self.assertTrue(replay.verify())
+        return replay
+
+    def _assert_rejected(self, replay):
+        self.assertTrue(self.ledger.is_spent(replay))
+        block = Block('QCauthor', [replay], Block.GENESIS)
+        self.assertRaises(AssertionError, check_transactions, block, 1,
+                          self.ledger)
+
+    def test_reencoded_signature(self):
+        self._assert_rejected(self._replayed(
+            self.transaction.signature().rstrip('\n'),
+            self.transaction.public_key().rstrip('\n')))
+
+    def test_malleated_signature(self):
+        order = SECP256k1.order
+        r, s = sigdecode_string(
+            binascii.a2b_base64(self.transaction.signature()), order)
+        self._assert_rejected(self._replayed(binascii.b2a_base64(
+            sigencode_string(r, order - s, order))))
+
+    def test_duplicate_in_block(self):
+        replay = self._replayed(self.transaction.signature().rstrip('\n'))
+        block = Block('QCauthor', [self.transaction, replay], Block.GENESIS)
+        self.assertRaises(AssertionError, check_transactions, block, 0,
+                          Ledger({self.sender['address']: 100.0}))
+
+
+if __name__ == '__main__':
+    unittest.main()